@@ -2,13 +2,22 @@ import argparse
 import logging
 import sys
 import Queue
-from migrator.Migrator import Migrator
+from migrator.Migrator import Migrator, PARTIAL_DIR, parse_platforms
 from migrator.ArtifactoryDockerAccess import ArtifactoryDockerAccess
 from migrator.DockerRegistryAccess import DockerRegistryAccess
 from migrator.QuayAccess import QuayAccess
 from migrator.DTRAccess import DTRAccess
+from migrator.ConnectionPool import get_default_pool, DEFAULT_IDLE_TIMEOUT
+from migrator.RetryPolicy import get_default_policy, DEFAULT_MAX_RETRIES
+from migrator.BandwidthGovernor import get_default_governor, parse_limits
+from migrator.BlobCache import BlobCache, DEFAULT_MAX_SIZE_MB
+from migrator.DigestIndex import DigestIndex
+from migrator.TargetTags import TargetTags
+from migrator.TagEnumerator import TagEnumerator, NUM_OF_ENUMERATORS
+from collections import OrderedDict
 import os
 import shutil
+import threading
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
 '''
@@ -26,7 +35,11 @@ dir_path = os.path.dirname(os.path.realpath(__file__))
 # Globals
 NUM_OF_WORKERS = 2
 MIN_NUM_OF_WORKERS = 1
-MAX_NUM_OF_WORKERS = 16
+MAX_NUM_OF_WORKERS = 256
+NUM_OF_SEGMENTS = 1
+SEGMENT_THRESHOLD_MB = 512
+# How often (in seconds) the progress of the tag enumeration is reported
+ENUMERATION_REPORT_INTERVAL = 10
 
 
 def add_extra_args(parser):
@@ -36,6 +49,59 @@ def add_extra_args(parser):
                                 help='Overwrite existing image/tag on the destination')
     parser.add_argument('--num-of-workers', dest='workers', type=int, default=NUM_OF_WORKERS,
                                 help='Number of worker threads. Defaults to %d.' % NUM_OF_WORKERS)
+    parser.add_argument('--max-num-of-workers', dest='max_workers', type=int,
+                                help='Let the number of workers adapt at runtime (to the throughput, latency and '
+                                     'throttling of the endpoints) between 1 and this value, starting from '
+                                     '--num-of-workers.')
+    parser.add_argument('--num-of-enumerators', dest='enumerators', type=int, default=NUM_OF_ENUMERATORS,
+                                help='Number of threads listing the tags of the repositories while the workers '
+                                     'migrate the tags already listed. Defaults to %d.' % NUM_OF_ENUMERATORS)
+    parser.add_argument('--stream-layers', dest='stream_layers', action='store_true',
+                                help='Stream layers from the source straight into Artifactory instead of downloading '
+                                     'them to the work directory first. Skips sha1 checksum deploys.')
+    parser.add_argument('--platform', dest='platforms', action='append', metavar='PLATFORM',
+                                help='Only migrate this platform of multi platform images (manifest lists and OCI '
+                                     'indexes), as <os>/<architecture>[/<variant>]. Can be repeated.')
+    parser.add_argument('--push-api', dest='push_api', action='store_true',
+                                help='Upload layers through the Docker V2 push API of Artifactory, mounting the '
+                                     'layers already stored under another image instead of deploying them again.')
+    parser.add_argument('--cache-dir', dest='cache_dir',
+                                help='Keep downloaded layers in this directory (kept between runs) and use them '
+                                     'instead of downloading the layers again.')
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=DEFAULT_MAX_SIZE_MB,
+                                help='Maximum size (in MB) of the layer cache, the least recently used layers are '
+                                     'evicted beyond it. Defaults to %d.' % DEFAULT_MAX_SIZE_MB)
+    parser.add_argument('--digest-index', dest='digest_index',
+                                help='SQLite file recording the sha1 of the layers (by sha256), kept between runs. '
+                                     'Layers whose sha1 is known are deployed by sha1 checksum without downloading '
+                                     'them.')
+    parser.add_argument('--seed-digest-index', dest='seed_digest_index', action='store_true',
+                                help='Add the layers already stored in the target repository to the digest index '
+                                     'before migrating.')
+    parser.add_argument('--segments', dest='segments', type=int, default=NUM_OF_SEGMENTS,
+                                help='Number of concurrent ranges large layers are downloaded in. Defaults to %d.'
+                                     % NUM_OF_SEGMENTS)
+    parser.add_argument('--segment-threshold', dest='segment_threshold', type=int, default=SEGMENT_THRESHOLD_MB,
+                                help='Minimal size (in MB) of a layer to be downloaded in segments. Defaults to %d.'
+                                     % SEGMENT_THRESHOLD_MB)
+    parser.add_argument('--max-retries', dest='max_retries', type=int, default=DEFAULT_MAX_RETRIES,
+                                help='Number of times a request failing with a transient error is sent again. '
+                                     'Defaults to %d.' % DEFAULT_MAX_RETRIES)
+    parser.add_argument('--connection-pool-size', dest='pool_size', type=int,
+                                help='Number of idle keep-alive connections kept per host. '
+                                     'Defaults to the number of workers plus the number of enumerators.')
+    parser.add_argument('--connection-idle-timeout', dest='pool_idle_timeout', type=int,
+                                default=DEFAULT_IDLE_TIMEOUT,
+                                help='Seconds an idle keep-alive connection is kept before being closed. '
+                                     'Defaults to %d.' % DEFAULT_IDLE_TIMEOUT)
+    parser.add_argument('--bandwidth-limit', dest='bandwidth_limits', action='append', metavar='LIMIT',
+                                help='Limit the bandwidth used by all the workers, as <read|write>[@<host>]=<rate>. '
+                                     'The rate is in bytes per second with an optional K, M or G suffix. Without '
+                                     'a host, the limit applies to all the transfers in that direction. '
+                                     'Can be repeated.')
+    parser.add_argument('--bandwidth-control-file', dest='bandwidth_control_file',
+                                help='File holding bandwidth limits (one per line, same format as '
+                                     '--bandwidth-limit), applied whenever it changes during the migration.')
     parser.add_argument('-v', '--verbose', action='store_true', help='Make the operation more talkative')
     # Provide a predefined set of images to import
     parser.add_argument('--image-file', dest='image_file',
@@ -251,20 +317,21 @@ def dtr_migration(args, work_dir):
     @registry - The source registry (for info only)
 '''
 def common_migration(args, work_dir, source, registry="NA"):
-    if not source.verify_is_v2():
+    configure_source(args, source)
+    # Verify the source registry while setting up and verifying the connection to Artifactory
+    is_v2, art_access = run_concurrently(
+        source.verify_is_v2,
+        lambda: setup_art_access(args.artifactory, args.username, args.password, args.repo, args.ignore_cert,
+                                  args.push_api))
+    if not is_v2:
         sys.exit("The provided URL does not appear to be a valid V2 repository.")
 
-    # Set up and verify the connection to Artifactory
-    art_access = setup_art_access(args.artifactory, args.username, args.password, args.repo, args.ignore_cert)
-
     image_names = []
-    q = Queue.Queue()
-    # Build the list of image/tags
+    images = []
+    # Build the list of images
     # If the user provides a set of images, don't query the upstream
     if 'image_file' in args and args.image_file:
         image_names, images = parse_image_file(args.image_file)
-        for image_name, tag in images:
-            q.put_nowait((image_name, tag))
     else:
         logging.info("Requesting catalog from source registry.")
         image_names = source.get_catalog()
@@ -273,14 +340,50 @@ def common_migration(args, work_dir, source, registry="NA"):
 
     if image_names:
         print "Found %d repositories." % len(image_names)
-        populate_tags(image_names, source, q)
-    if not q.empty():
+    if image_names or images:
         # Perform the migration
-        perform_migration(source, art_access, q, work_dir, registry)
+        perform_migration(source, art_access, image_names, images, work_dir, registry)
     else:
         print "Nothing to migrate."
 
 
+'''
+    Applies the user provided download settings to the source registry access
+    @param args - The user provided arguments
+    @param source - The source access
+'''
+def configure_source(args, source):
+    if args.segments < 1:
+        parser.error("--segments must be at least 1.")
+    source.set_segmented_download(args.segments, args.segment_threshold * 1024 * 1024)
+
+
+'''
+    Runs the provided functions concurrently and waits for all of them to finish
+    If any of them raised (including sys.exit), the first error is raised again in the calling thread
+    @param funcs - The functions to run (without arguments)
+    @return The results of the functions, in the same order
+'''
+def run_concurrently(*funcs):
+    results = [None] * len(funcs)
+    errors = []
+
+    def run(idx, func):
+        try:
+            results[idx] = func()
+        except BaseException as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=run, args=(idx, func)) for idx, func in enumerate(funcs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
 '''
     Set up and verify the connection to Artifactory
     @param artifactory_url - The URL to the Artifactory instance
@@ -288,10 +391,14 @@ def common_migration(args, work_dir, source, registry="NA"):
     @param password - The password (API Key, encrypted password, token) to access Artifactory
     @param repo - The repo name
     @param ignore_cert - True if the certificate to this instance should be ignored
+    @param push_api - True to upload the layers through the Docker V2 push API
 '''
-def setup_art_access(artifactory_url, username, password, repo, ignore_cert):
+def setup_art_access(artifactory_url, username, password, repo, ignore_cert, push_api=False):
     art_access = ArtifactoryDockerAccess(url=artifactory_url, username=username,
-                                   password=password, repo=repo, ignore_cert=ignore_cert)
+                                   password=password, repo=repo, ignore_cert=ignore_cert, push_api=push_api,
+                                   check_version=False)
+    # The version and the repository are checked concurrently
+    run_concurrently(art_access.load_version, art_access.is_valid_docker_repo)
     if not art_access.is_valid():
         sys.exit("The provided Artifactory URL or credentials do not appear valid.")
     if not art_access.is_valid_version():
@@ -303,42 +410,89 @@ def setup_art_access(artifactory_url, username, password, repo, ignore_cert):
     return art_access
 
 '''
-    Finds and populates the tags for a set of image names
-    @param image_names - A list of images names
-    @param source - Access to the source registry
-    @param q - The queue to populate with (image_name, tag) tuples
+    Reports the progress of the tag enumeration
+    @param counts - The counts of the TagEnumerator
+'''
+def report_enumeration(counts):
+    print ("Listed the tags of %(repositories)d/%(added)d repositories: %(tags)d tags found, %(queued)d queued for "
+           "migration, %(skipped)d already in Artifactory." % counts)
+    if counts['failed']:
+        print "Unable to list the tags of %d repositories." % counts['failed']
+
+
+'''
+    Reports the image/tags skipped because they already exist in Artifactory
+    @param skipped - The list of skipped (image_name, tag) tuples
 '''
-def populate_tags(image_names, source, q):
-    print "Populating set of image/tags..."
-    for image_name in image_names:
-        image_name = str(image_name)
-        tags = source.get_tags(image_name)
-        if tags:
-            print "Found %d tags for repository %s." % (len(tags), image_name)
-            for tag in tags:
-                tag = str(tag)
-                q.put_nowait((image_name, tag))
+def report_skipped(skipped):
+    if skipped:
+        print "Skipped %d images because they already exist in Artifactory." % len(skipped)
 
 
 '''
     Perform the migration
+    The tags of the images are listed (and the ones already in Artifactory left out) by a pool of enumerators while
+    the workers migrate the image/tags already listed.
     @param source - Access to the source registry
     @param art_access - Access to the Artifactory destination
-    @param q - The queue of (image, tag) tuples that have to be migrated
+    @param image_names - The images to migrate all the tags of
+    @param images - The (image, tag) tuples to migrate
     @param work_dir - The temporary working directory
     @registry - The source registry (for info only)
 '''
-def perform_migration(source, art_access, q, work_dir, registry="NA"):
-    print "Performing migration for %d image/tags." % q.qsize()
+def perform_migration(source, art_access, image_names, images, work_dir, registry="NA"):
     art_access.report_usage(registry)
-    m = Migrator(source, art_access, q, args.workers, args.overwrite, work_dir)
-    m.migrate()
-    print "Migration finished."
+    blob_cache = None
+    if args.cache_dir:
+        try:
+            blob_cache = BlobCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        except (IOError, OSError) as ex:
+            sys.exit("Failed to set up the layer cache in '%s': %s" % (args.cache_dir, ex))
+    digest_index = None
+    if args.digest_index:
+        try:
+            digest_index = DigestIndex(args.digest_index)
+        except Exception as ex:
+            sys.exit("Failed to open the digest index '%s': %s" % (args.digest_index, ex))
+        if args.seed_digest_index:
+            digests = art_access.get_layer_digests()
+            if digests:
+                digest_index.add_all(digests)
+                print "Added %d layers of the target repository to the digest index." % len(digests)
+    q = Queue.Queue()
+    # The tags in Artifactory are listed once per image, by the enumerators and shared with the workers
+    target_tags = None if args.overwrite else TargetTags(art_access)
+    m = Migrator(source, art_access, q, args.workers, args.overwrite, work_dir, stream_layers=args.stream_layers,
+                 max_workers=args.max_workers, blob_cache=blob_cache, digest_index=digest_index,
+                 target_tags=target_tags, platforms=args.platforms)
+    # The tags provided by the user are grouped per image, so they are checked against Artifactory once per image
+    tags = OrderedDict()
+    for image, tag in images:
+        tags.setdefault(image, []).append(tag)
+    print "Performing migration for %d repositories." % (len(tags) + len(image_names))
+    m.start()
+    enumerator = TagEnumerator(source, q, target_tags, args.enumerators)
+    enumerator.start()
+    for image, image_tags in tags.items():
+        enumerator.add(image, image_tags)
+    for image in image_names:
+        enumerator.add(image)
+    enumerator.close()
+    while not enumerator.wait(ENUMERATION_REPORT_INTERVAL):
+        report_enumeration(enumerator.get_counts())
+    counts = enumerator.get_counts()
+    report_enumeration(counts)
+    # Only wait for the workers once all the image/tags are queued, they are idle whenever the queue is empty
+    m.wait()
+    if not counts['queued']:
+        print "Nothing to migrate."
+    else:
+        print "Migration finished."
+    stats = get_default_pool().get_stats()
+    logging.info("Connections established: %d, connections reused: %d, idle connections evicted: %d."
+                 % (stats['handshakes'], stats['reuses'], stats['evictions']))
     # Report any skipped images
-    skipped_list = list(m.get_skipped_queue().queue)
-    skipped_count = len(skipped_list)
-    if skipped_list and skipped_count > 0:
-        print "Skipped %d images because they already exist in Artifactory." % skipped_count
+    report_skipped(enumerator.get_skipped() + list(m.get_skipped_queue().queue))
     # Report on any failures
     failure_list = list(m.get_failure_queue().queue)
     failure_count = len(failure_list)
@@ -350,15 +504,15 @@ def perform_migration(source, art_access, q, work_dir, registry="NA"):
 
 def quay_migration(args, work_dir):
     # Set up and verify the connection to Artifactory
-    art_access = setup_art_access(args.artifactory, args.username, args.password, args.repo, args.ignore_cert)
+    art_access = setup_art_access(args.artifactory, args.username, args.password, args.repo, args.ignore_cert,
+                                  args.push_api)
 
-    q = Queue.Queue()
+    image_names = []
+    images = []
 
     # If the user provides a set of images, don't query the upstream
     if 'image_file' in args and args.image_file:
         image_names, images = parse_image_file(args.image_file)
-        for image_name, tag in images:
-            q.put_nowait((image_name, tag))
     else:
         quay = QuayAccess(args.namespace, args.token)
         image_names = quay.get_catalog()
@@ -367,12 +521,12 @@ def quay_migration(args, work_dir):
     # Set up the token based connection to Quay
     source = DockerRegistryAccess(url="https://quay.io", username="$oauthtoken", password=args.token,
                                   ignore_cert=args.ignore_cert)
+    configure_source(args, source)
     if image_names:
         print "Found %d repositories." % len(image_names)
-        populate_tags(image_names, source, q)
-    if not q.empty():
+    if image_names or images:
         # Perform the migration
-        perform_migration(source, art_access, q, work_dir, "quay")
+        perform_migration(source, art_access, image_names, images, work_dir, "quay")
     else:
         print "Nothing to migrate."
 
@@ -390,6 +544,27 @@ def quay_ee_migration(args, work_dir):
         args.source_password = args.token
     generic_migration(args, work_dir, "quayee")
 
+'''
+    Deletes the work directory, except for the partial downloads a later run can resume
+    @param work_dir - The temporary work directory
+'''
+def clean_work_dir(work_dir):
+    if not os.path.exists(work_dir):
+        return
+    partial_dir = os.path.join(work_dir, PARTIAL_DIR)
+    if os.path.isdir(partial_dir) and os.listdir(partial_dir):
+        print "Keeping %d interrupted layer downloads in %s for the next run." % (len(os.listdir(partial_dir)),
+                                                                                 partial_dir)
+        for entry in os.listdir(work_dir):
+            if entry != PARTIAL_DIR:
+                path = os.path.join(work_dir, entry)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
 def setup_logging(level):
     fmt = "%(asctime)s [%(threadName)s] [%(levelname)s]"
     fmt += " (%(name)s:%(lineno)d) - %(message)s"
@@ -414,6 +589,31 @@ if __name__ == '__main__':
     else:
         setup_logging(logging.WARN)
 
+    if args.max_workers and (args.max_workers < args.workers or args.max_workers > MAX_NUM_OF_WORKERS):
+        parser.error("--max-num-of-workers must be between --num-of-workers and %d." % MAX_NUM_OF_WORKERS)
+
+    # Set up the keep-alive connection pool shared by all workers
+    if args.enumerators < 1:
+        parser.error("--num-of-enumerators must be at least 1.")
+    pool_size = args.pool_size if args.pool_size else max(args.workers, args.max_workers, 1) + args.enumerators
+    get_default_pool().configure(max_per_host=pool_size, idle_timeout=args.pool_idle_timeout)
+    get_default_policy().configure(max_retries=max(args.max_retries, 0))
+
+    try:
+        args.platforms = parse_platforms(args.platforms)
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    # Set up the bandwidth limits shared by all workers
+    try:
+        bandwidth_limits = parse_limits(args.bandwidth_limits)
+    except ValueError as ex:
+        parser.error(str(ex))
+    if args.bandwidth_control_file:
+        get_default_governor().watch_control_file(args.bandwidth_control_file, bandwidth_limits)
+    elif bandwidth_limits:
+        get_default_governor().set_limits(bandwidth_limits)
+
     # Create temp dir
     work_dir = os.path.join(dir_path, 'workdir')
     if not os.path.exists(work_dir):
@@ -425,6 +625,5 @@ if __name__ == '__main__':
     # Calls the appropriate function based on user's selected operation
     args.func(args, work_dir)
 
-    # Delete temp dir
-    if os.path.exists(work_dir):
-        shutil.rmtree(work_dir, ignore_errors=True)
+    # Delete temp dir, but keep interrupted downloads so the next run can resume them
+    clean_work_dir(work_dir)
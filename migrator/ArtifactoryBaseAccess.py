@@ -8,9 +8,20 @@ from distutils.version import LooseVersion
     * Limited 
 '''
 class ArtifactoryBaseAccess(HTTPAccess):
-    def __init__(self, url, username=None, password=None, ignore_cert=False, exlog=False):
+    def __init__(self, url, username=None, password=None, ignore_cert=False, exlog=False, version=None,
+                 check_version=True):
         super(ArtifactoryBaseAccess, self).__init__(url, username, password, ignore_cert, exlog)
         self.log = logging.getLogger(__name__)
+        # The version is only looked up if it is not already known (e.g. from the access this one is a copy of)
+        # With check_version False, it is left to load_version (e.g. to look it up concurrently with other checks)
+        self.version = version
+        if not version and check_version:
+            self.load_version()
+
+    '''
+        Looks up the version of the connected Artifactory
+    '''
+    def load_version(self):
         self.version = self.__get_version()
 
     '''
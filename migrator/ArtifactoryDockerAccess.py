@@ -1,7 +1,20 @@
 from ArtifactoryBaseAccess import ArtifactoryBaseAccess
+from HTTPAccess import release_response
 import logging
+import os
+import re
+import urllib
+import urlparse
 from distutils.version import LooseVersion
 
+# Globals
+# Number of digests looked up per AQL query
+AQL_BATCH_SIZE = 200
+# Number of tags requested per tags/list page
+TAGS_PAGE_SIZE = 1000
+# Size of the PATCH requests of a chunked (V2 push API) upload of a layer whose size is unknown
+PUSH_CHUNK_SIZE = 16 * 1024 * 1024
+
 '''
     Simple API for uploading Docker images to Artifactory
     * Uses basic AUTH (not tokens)
@@ -13,12 +26,35 @@ from distutils.version import LooseVersion
       * Try a checksum deploy first
       * If the checksum deploy fails, perform an upload
     2. Deploy the manifest
+
+    With push_api, layers are uploaded through the Docker V2 push API (/api/docker/<repo>/v2/) instead:
+    a layer already stored under another image is mounted, others are uploaded (in one request, or in chunks if
+    their size is unknown) and the upload only completes if Artifactory computes the expected digest.
 '''
 class ArtifactoryDockerAccess(ArtifactoryBaseAccess):
-    def __init__(self, url, repo, username=None, password=None, ignore_cert=False, exlog=False):
-        super(ArtifactoryDockerAccess, self).__init__(url, username, password, ignore_cert, exlog)
+    def __init__(self, url, repo, username=None, password=None, ignore_cert=False, exlog=False, version=None,
+                 push_api=False, check_version=True):
+        super(ArtifactoryDockerAccess, self).__init__(url, username, password, ignore_cert, exlog, version,
+                                                      check_version)
         self.log = logging.getLogger(__name__)
         self.repo = repo
+        self.__set_features()
+        self.sha256_reg_ex = re.compile(r'^[0-9a-f]{64}$')
+        self.valid_docker_repo = None
+        self.push_api = push_api
+
+    '''
+        Looks up the version of the connected Artifactory and the features it supports
+    '''
+    def load_version(self):
+        super(ArtifactoryDockerAccess, self).load_version()
+        self.__set_features()
+
+    def __set_features(self):
+        # Only try sha2 checksum deploys in versions that support sha2 and don't run into RTFACT-15096
+        self.sha2_deploy_supported = bool(self.version) and LooseVersion(self.version) >= LooseVersion("5.6.0")
+        # Items can be searched by sha256 with AQL since 5.5.0
+        self.aql_sha256_supported = bool(self.version) and LooseVersion(self.version) >= LooseVersion("5.5.0")
 
     '''
         Return true if the user exists
@@ -79,8 +115,7 @@ class ArtifactoryDockerAccess(ArtifactoryBaseAccess):
         @return True if successful, else False
     '''
     def checksum_deploy_sha2(self, image, tag, layer):
-        # Only try in versions that support sha2 and don't run into RTFACT-15096
-        if LooseVersion(self.version) < LooseVersion("5.6.0"):
+        if not self.sha2_deploy_supported:
             return False
         self.log.debug("Trying sha2 deploy of %s/%s with sha2: %s" % (image, tag, layer))
         headers = {
@@ -94,6 +129,38 @@ class ArtifactoryDockerAccess(ArtifactoryBaseAccess):
             return True
         return False
 
+    '''
+        Looks up which of the specified layers are stored in Artifactory, with batched AQL queries
+        Only content the user can read is found. Non admin users can only search items including their name, repo
+        and path, so these are always included.
+        @param layers - The layer sha256 sums
+        @return Dictionary of the sha256 sums found -> (their sha1, an image of this repository storing them),
+                or None if the lookup is not possible
+    '''
+    def find_layers(self, layers):
+        if not self.aql_sha256_supported:
+            return None
+        layers = [layer for layer in layers if self.sha256_reg_ex.match(layer)]
+        found = {}
+        for i in range(0, len(layers), AQL_BATCH_SIZE):
+            batch = layers[i:i + AQL_BATCH_SIZE]
+            query = 'items.find({"$or":[%s]}).include("name","repo","path","sha256","actual_sha1")' \
+                    % ','.join('{"sha256":"%s"}' % layer for layer in batch)
+            try:
+                msg = self.dorequest('POST', '/api/search/aql', query, {'Content-Type': 'text/plain'})
+            except Exception as ex:
+                self.log.info("Unable to look up layers with AQL: %s" % ex)
+                return None
+            if not isinstance(msg, dict):
+                return None
+            for item in msg.get('results', []):
+                if item.get('sha256'):
+                    # Checksum deploys work across repositories, mounts only within this one
+                    stored_image = self.__get_image(item.get('path')) if item.get('repo') == self.repo else None
+                    if item['sha256'] not in found or stored_image:
+                        found[item['sha256']] = item.get('actual_sha1'), stored_image
+        return found
+
     '''
         Uploads the specified layer (whose contents are in the file) to the specified image
         @param image - The image name
@@ -105,24 +172,145 @@ class ArtifactoryDockerAccess(ArtifactoryBaseAccess):
     def upload_layer(self, image, tag, layer, file):
         self.log.debug("Uploading layer %s for %s/%s using file at %s" % (layer, image, tag, file))
         #path_fragment = "/%s/%s/_uploads/sha256__%s;sha256=%s" % (self.repo, image, layer, layer)
+        if self.push_api:
+            with open(file, 'rb') as f:
+                pushed = self.push_layer(image, layer, f, os.fstat(f.fileno()).st_size)
+            if pushed is not None:
+                return pushed
         path_fragment = "/%s/%s/%s/sha256__%s;sha256=%s" % (self.repo, image, tag, layer, layer)
         stat = self.deployFileByStream(path=path_fragment, file_path=file)
         return stat == 201
 
     '''
-        Uploads an image's manifest
+        Uploads the specified layer (whose contents are read from the stream) to the specified image
+        @param image - The image name
+        @param tag - The tag name
+        @param layer - The layer sha256 sum
+        @param stream - The producer of the layer: a file like object or an iterator of strings
+        @param length - (optional) The size of the layer, sent with chunked transfer encoding if unknown
+        @return True is successful, else False
+    '''
+    def upload_layer_from_stream(self, image, tag, layer, stream, length=None):
+        self.log.debug("Streaming layer %s for %s/%s" % (layer, image, tag))
+        if self.push_api:
+            pushed = self.push_layer(image, layer, stream, length)
+            if pushed is not None:
+                return pushed
+        path_fragment = "/%s/%s/%s/sha256__%s;sha256=%s" % (self.repo, image, tag, layer, layer)
+        stat = self.deployStream(path=path_fragment, stream=stream, length=length)
+        return stat == 201
+
+    '''
+        Mounts a layer stored under another image of the repository into the specified image (V2 push API)
+        @param image - The image name
+        @param layer - The layer sha256 sum
+        @param from_image - The image the layer is stored under
+        @return True if the layer was mounted, else False
+    '''
+    def mount_layer(self, image, layer, from_image):
+        self.log.debug("Mounting layer %s from %s into %s" % (layer, from_image, image))
+        path = "%s?mount=sha256:%s&from=%s" % (self.__assemble_uploads_path(image), layer,
+                                               urllib.quote(from_image, safe=''))
+        resp, stat = self.do_unprocessed_request(method='POST', path=path)
+        release_response(resp)
+        if stat == 201:
+            return self.__is_expected_digest(resp, layer)
+        if stat == 202:
+            # The layer can't be mounted, an upload was started instead: cancel it
+            self.__cancel_upload(image, resp)
+        return False
+
+    '''
+        Uploads the specified layer (whose contents are read from the stream) through the V2 push API
+        A layer of known size is uploaded in a single request, otherwise it is sent in PUSH_CHUNK_SIZE chunks.
+        Either way, Artifactory only completes the upload if the content matches the layer digest.
+        @param image - The image name
+        @param layer - The layer sha256 sum
+        @param stream - The producer of the layer: a file like object or an iterator of strings
+        @param length - (optional) The size of the layer
+        @return True if successful, False if the upload failed,
+                or None if no upload could be started (nothing was read from the stream)
+    '''
+    def push_layer(self, image, layer, stream, length=None):
+        self.log.debug("Pushing layer %s for %s" % (layer, image))
+        resp, stat = self.do_unprocessed_request(method='POST', path=self.__assemble_uploads_path(image))
+        release_response(resp)
+        location = resp.info().get('Location') if stat == 202 else None
+        if not location:
+            self.log.warning("Unable to start an upload of layer %s for %s, got: %s" % (layer, image, stat))
+            return None
+        upload = self.__get_upload_path(image, location)
+        if length is None:
+            offset = 0
+            for chunk in self.__read_chunks(stream):
+                headers = {'Content-Range': '%d-%d' % (offset, offset + len(chunk) - 1)}
+                resp, stat = self.sendStream('PATCH', upload, chunk, len(chunk), headers)
+                release_response(resp)
+                location = resp.info().get('Location') if stat == 202 else None
+                if not location:
+                    self.log.error("Unable to upload a chunk of layer %s for %s, got: %s" % (layer, image, stat))
+                    self.__cancel_upload(image, None, upload)
+                    return False
+                upload = self.__get_upload_path(image, location)
+                offset += len(chunk)
+            stream, length = '', 0
+        separator = '&' if '?' in upload else '?'
+        resp, stat = self.sendStream('PUT', "%s%sdigest=sha256:%s" % (upload, separator, layer), stream, length)
+        release_response(resp)
+        if stat != 201:
+            self.log.error("Unable to complete the upload of layer %s for %s, got: %s" % (layer, image, stat))
+            self.__cancel_upload(image, None, upload)
+            return False
+        return self.__is_expected_digest(resp, layer)
+
+    '''
+        Deletes the specified layer of the specified image (e.g. when the uploaded content turned out to be invalid)
+        @param image - The image name
+        @param tag - The tag name
+        @param layer - The layer sha256 sum
+        @return True is successful, else False
+    '''
+    def delete_layer(self, image, tag, layer):
+        self.log.debug("Deleting layer %s for %s/%s" % (layer, image, tag))
+        resp, stat = self.do_unprocessed_request(method='DELETE',
+                                                 path=self.__assemble_path("%s/%s/sha256__%s" % (image, tag, layer)))
+        return stat == 204
+
+    '''
+        Returns the sha256 and sha1 of every layer stored in the repository (using the storage API)
+        @return List of (sha256, sha1), or None if the repository could not be listed
+    '''
+    def get_layer_digests(self):
+        try:
+            msg = self.dorequest('GET', '/api/storage/%s?list&deep=1&listFolders=0' % self.repo)
+        except Exception as ex:
+            self.log.error("Unable to list the layers of repository %s: %s" % (self.repo, ex))
+            return None
+        digests = {}
+        if isinstance(msg, dict):
+            for entry in msg.get('files', []):
+                # Layers are stored as .../sha256__<sha256>
+                name = entry.get('uri', '').rsplit('/', 1)[-1]
+                if name.startswith('sha256__') and entry.get('sha1'):
+                    digests[name[len('sha256__'):]] = entry['sha1']
+        return digests.items()
+
+    '''
+        Uploads an image's manifest (whose contents are read from the stream)
         @param image - The image name
         @param tag - The tag name
         @param type - The manifest type
-        @param file - The file path of the manifest's contents
+        @param stream - The producer of the manifest: a string, a file like object or an iterator of strings
+        @param length - (optional) The size of the manifest, sent with chunked transfer encoding if unknown
         @return True is successful, else False
     '''
-    def upload_manifest(self, image, tag, type, file):
-        self.log.debug("Uploading manifest for %s/%s of type %s using file at %s" % (image, tag, type, file))
+    def upload_manifest_from_stream(self, image, tag, type, stream, length=None):
+        self.log.debug("Uploading manifest for %s/%s of type %s" % (image, tag, type))
         headers = {
             'Content-Type': type
         }
-        stat = self.deployFileByStream(path=self.__assemble_manifest_path(image, tag), file_path=file, headers=headers)
+        stat = self.deployStream(path=self.__assemble_manifest_path(image, tag), stream=stream, length=length,
+                                 headers=headers)
         return stat == 201
 
     '''
@@ -130,6 +318,11 @@ class ArtifactoryDockerAccess(ArtifactoryBaseAccess):
         False else
     '''
     def is_valid_docker_repo(self):
+        if self.valid_docker_repo is None:
+            self.valid_docker_repo = self.__check_docker_repo()
+        return self.valid_docker_repo
+
+    def __check_docker_repo(self):
         self.log.info("Checking the Artifatory Docker repo '%s'" % self.repo)
         msg = self.get_call_wrapper("/api/repositories/%s" % self.repo)
         if msg and 'packageType' in msg and msg['packageType'] == 'docker':
@@ -151,6 +344,42 @@ class ArtifactoryDockerAccess(ArtifactoryBaseAccess):
 
 
 
+    '''
+        Returns all the tags of the specified image in the repository (following the pagination)
+        @param image - The image name
+        @return The list of tags (empty if the image does not exist), or None if they could not be listed
+    '''
+    def get_tags(self, image):
+        tags = []
+        # The list keeps the order of the tags, the set tells which ones were already listed
+        seen = set()
+        last = None
+        while True:
+            path = "/api/docker/%s/v2/%s/tags/list?n=%d" % (self.repo, image, TAGS_PAGE_SIZE)
+            if last:
+                path += "&last=" + urllib.quote(last, safe='')
+            out = self.get_code_and_msg_wrapper(path)
+            if not out:
+                return None
+            output, response = out
+            code = response.getcode()
+            if code == 404 and not tags:
+                return []
+            if code != 200 or not isinstance(output, dict):
+                self.log.info("Unable to list the tags of image %s in Artifactory, got: %s" % (image, code))
+                return None
+            page = output.get('tags') or []
+            new_tags = []
+            for tag in page:
+                if tag not in seen:
+                    seen.add(tag)
+                    new_tags.append(tag)
+            tags.extend(new_tags)
+            # A partial page is the last one (as is a page without anything new, should the server ignore 'last')
+            if len(page) < TAGS_PAGE_SIZE or not new_tags:
+                return tags
+            last = page[-1]
+
     '''
         Assembles a path based on the optional context, repo and fragment
         @param fragment - The fragment (which should NOT start with a '/')
@@ -158,6 +387,82 @@ class ArtifactoryDockerAccess(ArtifactoryBaseAccess):
     def __assemble_path(self, fragment):
         path = "/%s/%s" % (self.repo, fragment)
         return path
+    '''
+        Returns the image of a layer path (<image>/<tag or _uploads>) found in the repository, None if there is none
+    '''
+    def __get_image(self, path):
+        if not path or '/' not in path:
+            return None
+        return path.rsplit('/', 1)[0]
+
+    '''
+        Assembles the path upload sessions of the image are started with (V2 push API)
+    '''
+    def __assemble_uploads_path(self, image):
+        return "/api/docker/%s/v2/%s/blobs/uploads/" % (self.repo, image)
+
+    '''
+        Maps the Location of an upload session to a path under the root path of Artifactory
+        The Location may be absolute or relative, and relative to the root path or to the Docker V2 API of the repo
+        (with or without the repo key, depending on the reverse proxy method).
+    '''
+    def __get_upload_path(self, image, location):
+        out = urlparse.urlsplit(location)
+        path = out.path
+        rootpath = self.connection[2].rstrip('/')
+        if rootpath and path.startswith(rootpath + '/'):
+            path = path[len(rootpath):]
+        if path.startswith('/v2/'):
+            if path.startswith('/v2/%s/%s/' % (self.repo, image)):
+                path = '/v2/' + path[len('/v2/%s/' % self.repo):]
+            path = '/api/docker/%s%s' % (self.repo, path)
+        return path + ('?' + out.query if out.query else '')
+
+    '''
+        Generates the content of the stream (a file like object or an iterator of strings) in PUSH_CHUNK_SIZE chunks
+    '''
+    def __read_chunks(self, stream):
+        if hasattr(stream, 'read'):
+            for chunk in iter(lambda: stream.read(PUSH_CHUNK_SIZE), ''):
+                yield chunk
+            return
+        pending = []
+        size = 0
+        for data in stream:
+            pending.append(data)
+            size += len(data)
+            while size >= PUSH_CHUNK_SIZE:
+                data = ''.join(pending)
+                yield data[:PUSH_CHUNK_SIZE]
+                pending = [data[PUSH_CHUNK_SIZE:]]
+                size = len(pending[0])
+        if size:
+            yield ''.join(pending)
+
+    '''
+        Cancels an upload session (best effort)
+        @param resp - The response that started the session (None if path is provided)
+        @param path - (optional) The path of the session
+    '''
+    def __cancel_upload(self, image, resp, path=None):
+        if resp is not None:
+            location = resp.info().get('Location')
+            if not location:
+                return
+            path = self.__get_upload_path(image, location)
+        resp, stat = self.do_unprocessed_request(method='DELETE', path=path)
+        release_response(resp)
+
+    '''
+        True if the Docker-Content-Digest of the response (when provided) is the one of the layer
+    '''
+    def __is_expected_digest(self, resp, layer):
+        digest = resp.info().get('Docker-Content-Digest')
+        if digest and digest != 'sha256:' + layer:
+            self.log.error("Artifactory stored %s instead of layer %s" % (digest, layer))
+            return False
+        return True
+
     '''
         Assembles a path to deploy a manifest to
     '''
@@ -165,9 +470,19 @@ class ArtifactoryDockerAccess(ArtifactoryBaseAccess):
         path = "/api/docker/%s/v2/%s/manifests/%s" % (self.repo, image, tag)
         return path
 
+    '''
+        Create a copy of this object for a worker.
+        The capability data (version, repo validation) is shared so the copy does not make any calls.
+    '''
+    def fork(self):
+        clone = ArtifactoryDockerAccess(self.url, self.repo, self.username, self.password, self.ignore_cert,
+                                        self.exlog, version=self.version, push_api=self.push_api)
+        clone.valid_docker_repo = self.valid_docker_repo
+        return clone
+
     '''
         Create a deep copy of this object
     '''
     def __deepcopy__(self, memo):
-        return ArtifactoryDockerAccess(self.url, self.repo, self.username, self.password, self.ignore_cert, self.exlog)
+        return self.fork()
 
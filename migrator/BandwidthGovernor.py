@@ -0,0 +1,169 @@
+import logging
+import os
+import re
+import threading
+import time
+
+# Globals
+READ = 'read'
+WRITE = 'write'
+DEFAULT_POLL_INTERVAL = 5
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+'''
+    Token bucket refilled at rate bytes per second, holding up to a second worth of tokens
+    A transfer larger than the bucket is let through on credit, the next ones pay it back
+    @param rate - The number of bytes per second, 0 for unlimited
+'''
+class TokenBucket(object):
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.tokens = 0.0
+        self.last = time.time()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    '''
+        Takes nbytes out of the bucket
+        @return The number of seconds to wait before transferring them
+    '''
+    def consume(self, nbytes):
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            if self.tokens < 0:
+                return -self.tokens / self.rate
+            return 0
+
+
+'''
+    Limits the bandwidth used by all the workers, with separate read (download) and write (upload) budgets
+    * A global budget per direction, shared by all the endpoints
+    * A budget per direction and endpoint (host[:port]), on top of the global one
+    * The limits can be changed while transfers are running (see watch_control_file)
+
+    Limits are specified as '<read|write>[@<endpoint>]=<rate>', where rate is in bytes per second with an optional
+    K, M or G suffix and 0 means unlimited. Example: 'read@registry.example.com=20M'
+'''
+class BandwidthGovernor(object):
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.base_limits = {}
+
+    '''
+        Replaces the current limits
+        @param limits - Dictionary of (direction, endpoint or None for global) -> bytes per second
+    '''
+    def set_limits(self, limits):
+        with self.lock:
+            for key, bucket in self.buckets.items():
+                if key not in limits:
+                    bucket.set_rate(0)
+            for key, rate in limits.items():
+                bucket = self.buckets.get(key)
+                if bucket:
+                    bucket.set_rate(rate)
+                else:
+                    self.buckets[key] = TokenBucket(rate)
+        for (direction, endpoint), rate in sorted(limits.items()):
+            self.log.info("Bandwidth limit for %s%s: %s" % (direction, " from/to " + endpoint if endpoint else "",
+                                                           "%d bytes/s" % rate if rate else "unlimited"))
+
+    '''
+        Blocks until nbytes can be transferred without exceeding the limits
+        @param direction - READ or WRITE
+        @param endpoint - The host[:port] the bytes are transferred from/to
+        @param nbytes - The number of bytes about to be (or just) transferred
+    '''
+    def throttle(self, direction, endpoint, nbytes):
+        if not self.buckets:
+            return
+        delay = 0
+        for key in ((direction, None), (direction, endpoint)):
+            bucket = self.buckets.get(key)
+            if bucket:
+                delay = max(delay, bucket.consume(nbytes))
+        if delay:
+            time.sleep(delay)
+
+    '''
+        Watches a control file holding one limit per line (blank lines and lines starting with # are ignored)
+        Whenever the file changes, the limits become the base limits updated with the content of the file
+        @param path - The path of the control file (it may not exist yet)
+        @param base_limits - The limits that apply when the file does not override them
+        @param interval - The number of seconds between two checks of the file
+    '''
+    def watch_control_file(self, path, base_limits=None, interval=DEFAULT_POLL_INTERVAL):
+        self.base_limits = dict(base_limits or {})
+        # Taken before reading the file, so a change made while the watcher starts is not missed
+        last = self.__get_mtime(path)
+        self.set_limits(self.__read_control_file(path))
+        t = threading.Thread(target=self.__watch, args=(path, last, interval))
+        t.daemon = True
+        t.start()
+
+    def __watch(self, path, last, interval):
+        while True:
+            time.sleep(interval)
+            mtime = self.__get_mtime(path)
+            if mtime != last:
+                last = mtime
+                self.log.info("Bandwidth control file %s changed, applying it." % path)
+                self.set_limits(self.__read_control_file(path))
+
+    def __get_mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def __read_control_file(self, path):
+        limits = dict(self.base_limits)
+        try:
+            with open(path, 'r') as f:
+                lines = [line.strip() for line in f]
+        except IOError:
+            return limits
+        try:
+            limits.update(parse_limits(line for line in lines if line and not line.startswith('#')))
+        except ValueError as ex:
+            self.log.error("Ignoring bandwidth control file %s: %s" % (path, ex))
+            return dict(self.base_limits)
+        return limits
+
+
+'''
+    Parses limits in the '<read|write>[@<endpoint>]=<rate>' format
+    @param specs - The limits to parse
+    @return Dictionary of (direction, endpoint or None) -> bytes per second
+'''
+def parse_limits(specs):
+    limits = {}
+    for spec in specs or []:
+        match = re.match(r'^(read|write)(?:@([^=\s]+))?\s*=\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?$', spec.strip(), re.I)
+        if not match:
+            raise ValueError("Invalid bandwidth limit '%s', expected <read|write>[@<host>]=<rate>[K|M|G]" % spec)
+        direction, endpoint, rate, unit = match.groups()
+        limits[(direction.lower(), endpoint.lower() if endpoint else None)] = \
+            int(float(rate) * UNITS[unit.upper()])
+    return limits
+
+
+_default_governor = BandwidthGovernor()
+
+'''
+    Returns the process wide bandwidth governor shared by all HTTPAccess instances
+'''
+def get_default_governor():
+    return _default_governor
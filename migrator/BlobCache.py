@@ -0,0 +1,175 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+# Globals
+DEFAULT_MAX_SIZE_MB = 10240
+BLOBS_DIR = 'sha256'
+TMP_DIR = 'tmp'
+SHA1_SUFFIX = '.sha1'
+
+'''
+    Persistent content addressable cache of layers, shared by all the workers and kept between runs
+    * Layers are stored by sha256 (<path>/sha256/<2 first chars>/<sha256>) along with their sha1 (<sha256>.sha1)
+    * Entries are inserted atomically (written in <path>/tmp, synced to disk then renamed), so a crash never leaves
+      a partial layer
+    * When the cache grows beyond max_size bytes, the least recently used layers are evicted
+
+    @param path - The directory of the cache (created if needed)
+    @param max_size - The maximum number of bytes of layers kept in the cache
+'''
+class BlobCache(object):
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE_MB * 1024 * 1024):
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Anything left in the temporary directory is from an interrupted insertion
+        shutil.rmtree(os.path.join(self.path, TMP_DIR), ignore_errors=True)
+        os.makedirs(os.path.join(self.path, TMP_DIR))
+        self.__load()
+
+    '''
+        Opens the cached layer
+        @param sha2 - The sha256 of the layer
+        @return (file object, sha1, size), or None if the layer is not in the cache. The caller closes the file.
+    '''
+    def open(self, sha2):
+        with self.lock:
+            entry = self.entries.get(sha2)
+            if not entry:
+                self.misses += 1
+                return None
+            entry[1] = time.time()
+        blob = self.__get_blob_path(sha2)
+        try:
+            with open(blob + SHA1_SUFFIX, 'r') as f:
+                sha1 = f.read().strip()
+            fp = open(blob, 'rb')
+        except IOError as ex:
+            self.log.warning("Dropping unreadable cache entry %s: %s" % (sha2, ex))
+            self.__remove(sha2)
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            # The last use time survives restarts through the modification time
+            os.utime(blob, None)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return fp, sha1, entry[0]
+
+    '''
+        Moves a downloaded (and verified) layer into the cache
+        @param sha2 - The sha256 of the layer
+        @param sha1 - The sha1 of the layer
+        @param file - The file holding the layer, it is moved (or copied if it can't be moved) into the cache
+        @return True if the layer is now in the cache (the file is gone), else False (the file is left as is)
+    '''
+    def add(self, sha2, sha1, file):
+        size = os.path.getsize(file)
+        if size > self.max_size:
+            return False
+        with self.lock:
+            if sha2 in self.entries:
+                return False
+        blob = self.__get_blob_path(sha2)
+        tmp = os.path.join(self.path, TMP_DIR, uuid.uuid4().hex)
+        try:
+            if not os.path.exists(os.path.dirname(blob)):
+                try:
+                    os.makedirs(os.path.dirname(blob))
+                except OSError:
+                    # Created concurrently
+                    pass
+            with open(tmp + SHA1_SUFFIX, 'w') as f:
+                f.write(sha1)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp + SHA1_SUFFIX, blob + SHA1_SUFFIX)
+            try:
+                os.rename(file, tmp)
+            except OSError:
+                # The cache is on another file system
+                shutil.copyfile(file, tmp)
+                os.remove(file)
+            # The layer only becomes visible once it is complete, on disk
+            self.__sync(tmp)
+            os.rename(tmp, blob)
+        except (IOError, OSError) as ex:
+            self.log.warning("Unable to add layer %s to the cache: %s" % (sha2, ex))
+            for leftover in (tmp, tmp + SHA1_SUFFIX):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            return False
+        with self.lock:
+            if sha2 not in self.entries:
+                self.size += size
+            self.entries[sha2] = [size, time.time()]
+        self.__evict()
+        return True
+
+    '''
+        Returns the hit/miss counters and the size of the cache
+    '''
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'layers': len(self.entries), 'size': self.size}
+
+    def __sync(self, path):
+        with open(path, 'rb') as f:
+            os.fsync(f.fileno())
+
+    def __get_blob_path(self, sha2):
+        return os.path.join(self.path, BLOBS_DIR, sha2[:2], sha2)
+
+    def __load(self):
+        blobs_dir = os.path.join(self.path, BLOBS_DIR)
+        for root, dirs, files in os.walk(blobs_dir):
+            for name in files:
+                if name.endswith(SHA1_SUFFIX):
+                    if name[:-len(SHA1_SUFFIX)] not in files:
+                        # Interrupted between the sha1 and the layer
+                        os.remove(os.path.join(root, name))
+                    continue
+                blob = os.path.join(root, name)
+                if name + SHA1_SUFFIX not in files:
+                    # Never completed, the sha1 is written first
+                    os.remove(blob)
+                    continue
+                stat = os.stat(blob)
+                self.entries[name] = [stat.st_size, stat.st_mtime]
+                self.size += stat.st_size
+        self.log.info("Layer cache %s holds %d layers (%d bytes)." % (self.path, len(self.entries), self.size))
+        self.__evict()
+
+    def __evict(self):
+        while True:
+            with self.lock:
+                if self.size <= self.max_size or not self.entries:
+                    return
+                sha2 = min(self.entries, key=lambda key: self.entries[key][1])
+            self.log.info("Evicting layer %s from the cache." % sha2)
+            self.__remove(sha2)
+
+    def __remove(self, sha2):
+        with self.lock:
+            entry = self.entries.pop(sha2, None)
+            if entry:
+                self.size -= entry[0]
+        blob = self.__get_blob_path(sha2)
+        # Workers reading the layer keep their (already open) file
+        for path in (blob, blob + SHA1_SUFFIX):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
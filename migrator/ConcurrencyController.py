@@ -0,0 +1,119 @@
+import logging
+import threading
+
+# Globals
+DEFAULT_INTERVAL = 10
+# Multiplicative decrease when the endpoints throttle us (429/503)
+THROTTLE_DECREASE = 0.5
+# Multiplicative decrease when the latency spikes
+LATENCY_DECREASE = 0.75
+# The latency is considered spiking when it is this many times the best latency seen
+LATENCY_SPIKE = 2.0
+# Throughput is considered rising (or flat) as long as it doesn't drop below this fraction of the previous interval
+THROUGHPUT_TOLERANCE = 0.95
+
+'''
+    Limits the number of images being migrated concurrently and adjusts the limit at runtime (AIMD)
+    * Every interval, the limit grows by one while the throughput does not drop and the latency stays flat
+    * The limit is halved when the endpoints throttle us (429/503) and reduced when the latency spikes
+    * A fixed limit is used when minimum == maximum
+
+    @param initial - The initial limit
+    @param minimum - The lowest limit
+    @param maximum - The highest limit
+'''
+class ConcurrencyController(object):
+    def __init__(self, initial, minimum, maximum):
+        self.log = logging.getLogger(__name__)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = min(max(initial, minimum), maximum)
+        self.active = 0
+        self.condition = threading.Condition()
+        # Statistics of the current interval
+        self.completed = 0
+        self.throttled = 0
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.saturated = False
+        # Reference values
+        self.previous_throughput = None
+        self.best_latency = None
+
+    '''
+        True if the limit is adjusted at runtime
+    '''
+    def is_adaptive(self):
+        return self.minimum != self.maximum
+
+    '''
+        Blocks until one more image can be migrated
+    '''
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+            if self.active >= self.limit:
+                self.saturated = True
+
+    '''
+        Releases the slot taken by acquire
+        @param completed - True if an image was migrated (counts towards the throughput)
+    '''
+    def release(self, completed=True):
+        with self.condition:
+            self.active -= 1
+            if completed:
+                self.completed += 1
+            self.condition.notify()
+
+    '''
+        Request observer (see HTTPAccess.add_request_observer)
+        @param status - The status of the response, None on connection errors
+        @param elapsed - The time (in seconds) it took to get the response
+    '''
+    def on_response(self, status, elapsed):
+        with self.condition:
+            if status in (429, 503):
+                self.throttled += 1
+            elif status is not None:
+                self.latency_sum += elapsed
+                self.latency_count += 1
+
+    '''
+        Adjusts the limit based on what happened since the last call
+        @param interval - The time (in seconds) since the last call
+    '''
+    def adjust(self, interval):
+        with self.condition:
+            throughput = self.completed / float(interval)
+            latency = self.latency_sum / self.latency_count if self.latency_count else None
+            previous_limit = self.limit
+            if self.throttled:
+                self.limit = max(self.minimum, int(self.limit * THROTTLE_DECREASE))
+                reason = "throttled %d times" % self.throttled
+            elif latency is not None and self.best_latency and latency > self.best_latency * LATENCY_SPIKE:
+                self.limit = max(self.minimum, int(self.limit * LATENCY_DECREASE))
+                reason = "latency spiked"
+            elif self.saturated and (self.previous_throughput is None
+                                     or throughput >= self.previous_throughput * THROUGHPUT_TOLERANCE):
+                self.limit = min(self.maximum, self.limit + 1)
+                reason = "throughput holding up"
+            else:
+                reason = "steady"
+            if latency is not None and (self.best_latency is None or latency < self.best_latency):
+                self.best_latency = latency
+            self.previous_throughput = throughput
+            self.completed = 0
+            self.throttled = 0
+            self.latency_sum = 0.0
+            self.latency_count = 0
+            self.saturated = self.active >= self.limit
+            self.condition.notify_all()
+        if self.limit != previous_limit:
+            self.log.info("Concurrency changed from %d to %d (%s), bounds %d-%d." %
+                          (previous_limit, self.limit, reason, self.minimum, self.maximum))
+        self.log.info("Concurrency %d (bounds %d-%d), %.2f images/s, latency %s." %
+                      (self.limit, self.minimum, self.maximum, throughput,
+                       "%.3fs" % latency if latency is not None else "n/a"))
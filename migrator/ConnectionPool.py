@@ -0,0 +1,298 @@
+import httplib
+import logging
+import socket
+import threading
+import time
+import urllib2
+from StringIO import StringIO
+from urllib import addinfourl
+from StreamBody import StreamBody
+
+# Globals
+DEFAULT_MAX_PER_HOST = 16
+DEFAULT_IDLE_TIMEOUT = 30
+# Bodies up to this size are read right away so the connection can go back to the pool immediately
+EAGER_READ_LIMIT = 64 * 1024
+
+'''
+    Thread safe pool of keep-alive HTTP(S) connections, keyed per scheme/host
+    * Idle connections are reused most recently used first
+    * Connections idle for longer than idle_timeout are evicted
+    * Keeps track of how many connections had to be established (handshakes) and how many were reused
+
+    @param max_per_host - The maximum number of idle connections kept per host
+    @param idle_timeout - The number of seconds an idle connection is kept before being evicted
+'''
+class ConnectionPool(object):
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.log = logging.getLogger(__name__)
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.handshakes = 0
+        self.reuses = 0
+        self.evictions = 0
+
+    '''
+        Changes the pool settings, only affects connections released after the call
+        @param max_per_host - The maximum number of idle connections kept per host
+        @param idle_timeout - The number of seconds an idle connection is kept before being evicted
+    '''
+    def configure(self, max_per_host=None, idle_timeout=None):
+        with self.lock:
+            if max_per_host is not None:
+                self.max_per_host = max_per_host
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+
+    '''
+        Returns an idle connection for the key or a new one created by the factory
+        @param key - The pool key of the connection (scheme, host...)
+        @param factory - Callable creating a new (not yet connected) connection
+        @param fresh - If True, never hand out an idle connection
+        @return (connection, reused)
+    '''
+    def acquire(self, key, factory, fresh=False):
+        now = time.time()
+        conn = None
+        stale = []
+        with self.lock:
+            entries = self.idle.get(key, [])
+            alive = [(c, last) for c, last in entries if now - last <= self.idle_timeout]
+            stale = [c for c, last in entries if now - last > self.idle_timeout]
+            if alive and not fresh:
+                conn, last = alive.pop()
+                self.reuses += 1
+            else:
+                self.handshakes += 1
+            self.idle[key] = alive
+            self.evictions += len(stale)
+        for c in stale:
+            c.close()
+        if conn:
+            return conn, True
+        return factory(), False
+
+    '''
+        Returns a connection whose last response was fully consumed to the pool
+        @param key - The pool key of the connection
+        @param conn - The connection
+    '''
+    def release(self, key, conn):
+        with self.lock:
+            entries = self.idle.setdefault(key, [])
+            if len(entries) < self.max_per_host:
+                entries.append((conn, time.time()))
+                return
+        conn.close()
+
+    '''
+        Closes all the idle connections
+    '''
+    def close_all(self):
+        with self.lock:
+            entries = self.idle
+            self.idle = {}
+        for conns in entries.values():
+            for c, last in conns:
+                c.close()
+
+    '''
+        Returns the handshake/reuse counters of this pool
+    '''
+    def get_stats(self):
+        with self.lock:
+            return {
+                'handshakes': self.handshakes,
+                'reuses': self.reuses,
+                'evictions': self.evictions,
+                'idle': sum(len(entries) for entries in self.idle.values())
+            }
+
+
+_default_pool = ConnectionPool()
+
+'''
+    Returns the process wide connection pool shared by all HTTPAccess instances
+'''
+def get_default_pool():
+    return _default_pool
+
+
+'''
+    Socket like wrapper around a pooled response.
+    Hands the connection back to the pool once the body has been fully read.
+'''
+class PooledBody(object):
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+
+    def recv(self, amt=None):
+        try:
+            data = self.response.read(amt)
+        except:
+            self.close()
+            raise
+        if self.response.isclosed():
+            self.__finish()
+        return data
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        # Body was not fully consumed, the connection can't be reused
+        if conn:
+            conn.close()
+        self.response.close()
+
+    def __finish(self):
+        conn, self.conn = self.conn, None
+        if conn:
+            if self.response.will_close:
+                conn.close()
+            else:
+                self.pool.release(self.key, conn)
+
+
+'''
+    Base for urllib2 handlers that use the connection pool instead of a connection per request
+'''
+class KeepAliveHandler(object):
+    def __init__(self, pool=None):
+        self.pool = pool or get_default_pool()
+
+    def http_request(self, req):
+        return self.prepare_request(req)
+
+    def https_request(self, req):
+        return self.prepare_request(req)
+
+    '''
+        Same as urllib2's request preparation, but also handles bodies produced on the fly (StreamBody)
+    '''
+    def prepare_request(self, req):
+        body = req.data
+        if not isinstance(body, StreamBody):
+            return self.do_request_(req)
+        # Don't let urllib2 try to measure the body
+        req.data = None
+        try:
+            req = self.do_request_(req)
+        finally:
+            req.data = body
+        if not req.has_header('Content-type'):
+            req.add_unredirected_header('Content-type', 'application/octet-stream')
+        if body.is_chunked():
+            req.add_unredirected_header('Transfer-encoding', 'chunked')
+        elif not req.has_header('Content-length'):
+            req.add_unredirected_header('Content-length', str(body.length))
+        return req
+
+    def do_pooled_open(self, http_class, req, pool_key, **http_conn_args):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+        tunnel_headers = {}
+        if req._tunnel_host and 'Proxy-Authorization' in headers:
+            # Proxy-Authorization should not be sent to origin server.
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+        key = pool_key + (host, req._tunnel_host)
+
+        def factory():
+            h = http_class(host, timeout=req.timeout, **http_conn_args)
+            h.set_debuglevel(self._debuglevel)
+            if req._tunnel_host:
+                h.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            return h
+
+        # A body that can't be produced again is never sent on an idle connection, which the server may have closed
+        # in the meantime: the request could not be sent again
+        replayable = not hasattr(req.data, 'read') and \
+            (not isinstance(req.data, StreamBody) or req.data.is_replayable())
+        conn, reused = self.pool.acquire(key, factory, fresh=not replayable)
+        try:
+            r = self.__send(conn, req, headers)
+        except (socket.error, httplib.HTTPException) as err:
+            conn.close()
+            # A reused connection may have been dropped by the server while idle, try once more on a new one
+            if not reused or isinstance(req.data, StreamBody) or hasattr(req.data, 'read'):
+                raise urllib2.URLError(err)
+            conn, reused = self.pool.acquire(key, factory, fresh=True)
+            try:
+                r = self.__send(conn, req, headers)
+            except (socket.error, httplib.HTTPException) as err:
+                conn.close()
+                raise urllib2.URLError(err)
+            except:
+                conn.close()
+                raise
+        except:
+            # The request was interrupted half way (e.g. the body producer failed), the connection is unusable
+            conn.close()
+            raise
+        return self.__wrap(key, conn, r, req)
+
+    def __send(self, conn, req, headers):
+        if isinstance(req.data, StreamBody):
+            header_names = [name.lower() for name in headers]
+            skips = {}
+            if 'host' in header_names:
+                skips['skip_host'] = 1
+            if 'accept-encoding' in header_names:
+                skips['skip_accept_encoding'] = 1
+            conn.putrequest(req.get_method(), req.get_selector(), **skips)
+            for name, value in headers.iteritems():
+                conn.putheader(name, value)
+            conn.endheaders()
+            req.data.write_to(conn)
+        else:
+            conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        return conn.getresponse(buffering=True)
+
+    def __wrap(self, key, conn, r, req):
+        if r.length is not None and r.length <= EAGER_READ_LIMIT:
+            try:
+                fp = StringIO(r.read())
+            except (socket.error, httplib.HTTPException) as err:
+                conn.close()
+                raise urllib2.URLError(err)
+            if r.will_close:
+                conn.close()
+            else:
+                self.pool.release(key, conn)
+        else:
+            fp = socket._fileobject(PooledBody(self.pool, key, conn, r), close=True)
+        resp = addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+class KeepAliveHTTPHandler(KeepAliveHandler, urllib2.HTTPHandler):
+    def __init__(self, pool=None):
+        urllib2.HTTPHandler.__init__(self)
+        KeepAliveHandler.__init__(self, pool)
+
+    def http_open(self, req):
+        return self.do_pooled_open(httplib.HTTPConnection, req, ('http',))
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandler, urllib2.HTTPSHandler):
+    def __init__(self, pool=None, context=None):
+        urllib2.HTTPSHandler.__init__(self, context=context)
+        KeepAliveHandler.__init__(self, pool)
+
+    def https_open(self, req):
+        # Connections verified differently must never be shared
+        if self._context:
+            verification = (self._context.verify_mode, self._context.check_hostname)
+        else:
+            verification = None
+        return self.do_pooled_open(httplib.HTTPSConnection, req, ('https', verification), context=self._context)
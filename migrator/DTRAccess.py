@@ -67,6 +67,18 @@ class DTRAccess(DockerEEHTTPAccess, DockerRegistryAccess):
     def get_tags(self, image):
         return self.get_image_tags(image)
 
+    '''
+        Create a copy of this object for a worker (a DTRAccess, so the copy lists tags through the DTR API)
+        The credentials and the current token are shared so the copy does not need to authenticate again.
+    '''
+    def fork(self):
+        clone = DTRAccess(url=self.url, username=self.username, password=self.password, ignore_cert=self.ignore_cert,
+                          exlog=self.exlog)
+        clone.token_access = self.token_access.fork()
+        clone.access = clone.token_access
+        clone.set_segmented_download(self.segments, self.segment_threshold)
+        return clone
+
 
 
 
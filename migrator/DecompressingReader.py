@@ -0,0 +1,64 @@
+import zlib
+
+# Globals
+ACCEPT_ENCODING = 'gzip, deflate'
+BLOCK_SIZE = 64 * 1024
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+'''
+    File like wrapper that decompresses a gzip or deflate encoded body as it is read
+    Only the compressed block being inflated and what the caller did not read yet are held in memory.
+
+    @param fp - The file like object holding the compressed body
+    @param encoding - The Content-Encoding of the body ('gzip', 'x-gzip' or 'deflate')
+'''
+class DecompressingReader(object):
+    def __init__(self, fp, encoding):
+        self.fp = fp
+        self.deflate = encoding == 'deflate'
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS if self.deflate else GZIP_WBITS)
+        self.started = False
+        self.buffer = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            blocks = [self.buffer]
+            while not self.eof:
+                blocks.append(self.__inflate_block())
+            self.buffer = ''
+            return ''.join(blocks)
+        while not self.eof and len(self.buffer) < size:
+            self.buffer += self.__inflate_block()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.fp.close()
+
+    def __inflate_block(self):
+        data = self.fp.read(BLOCK_SIZE)
+        if not data:
+            self.eof = True
+            return self.decompressor.flush()
+        try:
+            inflated = self.decompressor.decompress(data)
+        except zlib.error:
+            if not self.deflate or self.started:
+                raise
+            # Some servers send 'deflate' bodies as raw deflate streams, without the zlib header
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            inflated = self.decompressor.decompress(data)
+        self.started = True
+        return inflated
+
+
+'''
+    Returns a file like object to read the decoded body of a response from
+    @param resp - The response (anything with info() and read())
+'''
+def decode_response(resp):
+    encoding = resp.info().get('Content-Encoding', '').strip().lower()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        return DecompressingReader(resp, encoding)
+    return resp
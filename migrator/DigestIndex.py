@@ -0,0 +1,57 @@
+import logging
+import sqlite3
+import threading
+
+'''
+    Persistent index of layer digests (sha256 -> sha1) kept in an SQLite file and shared by all the workers
+    Knowing the sha1 of a layer allows a sha1 checksum deploy without downloading the layer first.
+
+    @param path - The path of the SQLite file (created if needed)
+'''
+class DigestIndex(object):
+    def __init__(self, path):
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        # The connection is shared by the workers, the lock serializes its use
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS digests (sha256 TEXT PRIMARY KEY, sha1 TEXT NOT NULL)")
+            self.connection.commit()
+
+    '''
+        Returns the sha1 of the layer, or None if it is not known
+        @param sha2 - The sha256 of the layer
+    '''
+    def get_sha1(self, sha2):
+        with self.lock:
+            row = self.connection.execute("SELECT sha1 FROM digests WHERE sha256 = ?", (sha2,)).fetchone()
+        return row[0] if row else None
+
+    '''
+        Records the sha1 of a layer
+        @param sha2 - The sha256 of the layer
+        @param sha1 - The sha1 of the layer
+    '''
+    def add(self, sha2, sha1):
+        self.add_all([(sha2, sha1)])
+
+    '''
+        Records the sha1 of several layers at once
+        @param digests - Iterable of (sha256, sha1)
+    '''
+    def add_all(self, digests):
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO digests (sha256, sha1) VALUES (?, ?)", digests)
+            self.connection.commit()
+
+    '''
+        Returns the number of layers in the index
+    '''
+    def count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
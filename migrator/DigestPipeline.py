@@ -0,0 +1,192 @@
+import hashlib
+import threading
+import time
+from functools import partial
+from Queue import Queue
+
+# Globals
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 1024 * 1024
+# Reads taking less than this many seconds grow the chunk size, reads taking 4 times longer shrink it
+TARGET_READ_TIME = 0.005
+# Number of blocks a reader can be ahead of the hashing thread
+PIPELINE_DEPTH = 8
+
+'''
+    Computes the sha256 (and optionally the sha1) of a stream of blocks on a separate thread
+    The thread hashing the blocks runs alongside the one reading them (hashlib releases the GIL for large blocks),
+    so network reads and digests overlap. At most depth blocks are queued, a reader getting too far ahead waits.
+
+    @param sha1 - False to skip the sha1 (when it won't be used)
+    @param depth - The number of blocks queued before update blocks
+'''
+class DigestPipeline(object):
+    def __init__(self, sha1=True, depth=PIPELINE_DEPTH):
+        self.sha256 = hashlib.sha256()
+        self.sha1 = hashlib.sha1() if sha1 else None
+        self.blocks = Queue(depth)
+        self.thread = None
+        self.error = None
+        self.closed = False
+
+    '''
+        Queues a block to be hashed
+        @param data - The block (a string or a memoryview)
+        @param release - (optional) Callable invoked once the block has been hashed (e.g. to reuse its buffer)
+    '''
+    def update(self, data, release=None):
+        if self.closed:
+            raise ValueError("Digest pipeline already closed.")
+        if not self.thread:
+            self.thread = threading.Thread(target=self.__run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.blocks.put((data, release))
+
+    '''
+        Waits until all the queued blocks are hashed and stops the hashing thread
+        Called by the digest getters, and should be called when the digests are not needed after all.
+    '''
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.thread:
+            self.blocks.put((None, None))
+            self.thread.join()
+        if self.error:
+            raise self.error
+
+    def sha256_hexdigest(self):
+        self.close()
+        return self.sha256.hexdigest()
+
+    '''
+        Returns the sha1, or None if it is not computed
+    '''
+    def sha1_hexdigest(self):
+        self.close()
+        return self.sha1.hexdigest() if self.sha1 else None
+
+    def __run(self):
+        while True:
+            data, release = self.blocks.get()
+            if data is None:
+                return
+            try:
+                if not self.error:
+                    self.sha256.update(data)
+                    if self.sha1:
+                        self.sha1.update(data)
+            except Exception as ex:
+                self.error = ex
+            finally:
+                if release:
+                    release()
+
+
+'''
+    Adapts the size of the reads to the throughput of the source
+    Fast reads (data readily available) grow the chunk size, so fewer calls move more data, and slow reads shrink
+    it, so progress (and bandwidth limits) stay smooth on slow links.
+
+    @param minimum - The smallest chunk size
+    @param maximum - The largest chunk size
+'''
+class ChunkSizer(object):
+    def __init__(self, minimum=MIN_CHUNK, maximum=MAX_CHUNK):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = minimum
+
+    '''
+        Records a read and adjusts the chunk size
+        @param nbytes - The number of bytes read
+        @param elapsed - The time the read took (in seconds)
+    '''
+    def record(self, nbytes, elapsed):
+        if nbytes < self.size:
+            # Short read (end of the content or of the range), says nothing about the throughput
+            return
+        if elapsed < TARGET_READ_TIME:
+            self.size = min(self.size * 2, self.maximum)
+        elif elapsed > TARGET_READ_TIME * 4:
+            self.size = max(self.size // 2, self.minimum)
+
+
+'''
+    Fixed set of reusable buffers, so reads into them don't allocate a new string per block
+    Buffers are allocated on first use, acquire waits when all of them are in use.
+
+    @param count - The number of buffers
+    @param size - The size of each buffer
+'''
+class BufferRing(object):
+    def __init__(self, count=PIPELINE_DEPTH + 2, size=MAX_CHUNK):
+        self.count = count
+        self.size = size
+        self.allocated = 0
+        self.lock = threading.Lock()
+        self.free = Queue()
+
+    def acquire(self):
+        with self.lock:
+            if self.free.empty() and self.allocated < self.count:
+                self.allocated += 1
+                return bytearray(self.size)
+        return self.free.get()
+
+    def release(self, buf):
+        self.free.put(buf)
+
+
+'''
+    Copies a source to a destination and/or a digest pipeline, one block at a time
+    Sources providing readinto (e.g. files) are read into the buffers of the ring (if any), other sources are read
+    with read. Yields the size of every block once it is written, so the caller knows how far the copy got if it is
+    interrupted.
+    @param src - The file like object to read from
+    @param dst - (optional) The file like object to write to
+    @param pipeline - (optional) The DigestPipeline the blocks are hashed with
+    @param limit - (optional) The maximum number of bytes to copy
+    @param throttle - (optional) Callable invoked with the size of every block read (bandwidth limits)
+    @param sizer - (optional) The ChunkSizer adapting the size of the reads
+    @param ring - (optional) The BufferRing to read into
+'''
+def pump(src, dst=None, pipeline=None, limit=None, throttle=None, sizer=None, ring=None):
+    sizer = sizer or ChunkSizer()
+    readinto = getattr(src, 'readinto', None) if ring else None
+    total = 0
+    while limit is None or total < limit:
+        size = sizer.size if limit is None else min(sizer.size, limit - total)
+        release = None
+        start = time.time()
+        if readinto:
+            buf = ring.acquire()
+            nbytes = readinto(memoryview(buf)[:min(size, ring.size)])
+            if not nbytes:
+                ring.release(buf)
+                return
+            data = memoryview(buf)[:nbytes]
+            release = partial(ring.release, buf)
+        else:
+            data = src.read(size)
+            if not data:
+                return
+            nbytes = len(data)
+        sizer.record(nbytes, time.time() - start)
+        try:
+            if throttle:
+                throttle(nbytes)
+            if dst:
+                dst.write(data)
+        except:
+            if release:
+                release()
+            raise
+        if pipeline:
+            pipeline.update(data, release)
+        elif release:
+            release()
+        total += nbytes
+        yield nbytes
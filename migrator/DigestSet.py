@@ -0,0 +1,42 @@
+import binascii
+import threading
+
+'''
+    Set of hex digests (e.g. sha256 sums) held as raw bytes, which takes about half the memory of the hex strings
+    Invalid digests are never members.
+
+    @param digests - (optional) The initial digests
+'''
+class DigestSet(object):
+    def __init__(self, digests=None):
+        self.lock = threading.Lock()
+        self.digests = set()
+        for digest in digests or []:
+            self.add(digest)
+
+    def add(self, digest):
+        raw = self.__to_raw(digest)
+        if raw:
+            with self.lock:
+                self.digests.add(raw)
+
+    def discard(self, digest):
+        raw = self.__to_raw(digest)
+        if raw:
+            with self.lock:
+                self.digests.discard(raw)
+
+    def __contains__(self, digest):
+        raw = self.__to_raw(digest)
+        with self.lock:
+            return raw in self.digests
+
+    def __len__(self):
+        with self.lock:
+            return len(self.digests)
+
+    def __to_raw(self, digest):
+        try:
+            return binascii.unhexlify(digest)
+        except (TypeError, binascii.Error):
+            return None
@@ -1,11 +1,15 @@
 import json
 from HTTPAccess import HTTPAccess
 from DockerTokenAccess import DockerTokenAccess
+from DigestPipeline import DigestPipeline, ChunkSizer, BufferRing, pump
+from Manifest import Manifest, MANIFEST_LIST_V2, OCI_INDEX, MANIFEST_V2, OCI_MANIFEST, MANIFEST_V1
 import re
-import hashlib
 import logging
 import json
-
+import os
+import socket
+import httplib
+import threading
 
 '''
     Provides basic access to a Docker registry
@@ -24,9 +28,14 @@ class DockerRegistryAccess:
         self.username = username
         self.password = password
         self.ignore_cert = ignore_cert
-        self.CHUNK = 16 * 1024
         self.log = logging.getLogger(__name__)
         self.link_reg_ex = re.compile('<(.*)>;.*rel="next"')
+        self.content_range_reg_ex = re.compile(r'^bytes (\d+)-')
+        # Number of times an interrupted layer download is resumed before giving up
+        self.resume_attempts = 5
+        # Layers of at least segment_threshold bytes are downloaded as that many concurrent ranges
+        self.segments = 1
+        self.segment_threshold = 512 * 1024 * 1024
         self.anon_access = HTTPAccess(url=self.url, ignore_cert=self.ignore_cert)
         self.valid_methods = ['token', 'basic']
         if not method:
@@ -45,6 +54,15 @@ class DockerRegistryAccess:
                                            ignore_cert=self.ignore_cert)
             self.access = self.basic_access
 
+    '''
+        Enables downloading large layers as several ranges fetched concurrently
+        @param segments - The number of concurrent ranges (1 disables segmented downloads)
+        @param threshold - The minimal size (in bytes) of a layer to be downloaded in segments
+    '''
+    def set_segmented_download(self, segments, threshold):
+        self.segments = max(segments, 1)
+        self.segment_threshold = threshold
+
     '''
         Verifies that the repository is a valid V2 repository
     '''
@@ -119,95 +137,247 @@ class DockerRegistryAccess:
         return output['tags']
 
     '''
-        Downloads a manifest for the specified image/tag or image/digest
+        Gets a manifest for the specified image/tag or image/digest (kept in memory, manifests are small)
         @param image - The image name
         @param reference - The reference, which can be either a tag name or a digest
-        @param file - The file to store the contents into
+        @return The Manifest, or None if it could not be downloaded (or is not a valid manifest)
     '''
-    def download_manifest(self, image, reference, file):
-        # For now only accept v2.2 and not fat manifest
+    def get_manifest(self, image, reference):
+        # Manifest lists and OCI indexes are accepted, so multi platform images are not converted by the registry
         headers = {
-            'Accept': 'application/vnd.docker.distribution.manifest.v2+json, '
-                      'application/vnd.docker.distribution.manifest.v1+json, application/json'
+            'Accept': ', '.join([MANIFEST_LIST_V2, OCI_INDEX, MANIFEST_V2, OCI_MANIFEST, MANIFEST_V1,
+                                 'application/json'])
         }
         response = self.access.get_raw_call_wrapper(url="/v2/" + image + "/manifests/" + reference, headers=headers)
-        if response.getcode() == 200:
-            try:
-                with open(file, 'wb') as f:
-                    contents = response.read()
-                    f.write(contents)
-                return True
-            except Exception as ex:
-                self.log.error("Failed to download manifest for image " + image)
-                return False
-        return False
+        if not response or response.getcode() != 200:
+            return None
+        try:
+            return Manifest(response.read())
+        except Exception as ex:
+            self.log.error("Failed to read manifest %s for image %s: %s" % (reference, image, ex))
+            return None
+
+    '''
+        Fetches, ahead of time, the tokens needed to pull the specified images
+        @param images - The names of the images about to be pulled
+    '''
+    def prefetch_tokens(self, images):
+        if self.method == 'token':
+            self.token_access.prefetch_tokens(images)
+
+    '''
+        Blocks until nbytes read from the registry fit in the bandwidth limits
+        (for callers reading a response returned by open_layer)
+        @param nbytes - The number of bytes read
+    '''
+    def throttle_read(self, nbytes):
+        self.access.throttle_read(nbytes)
+
+    '''
+        Opens the specified layer from the specified image for reading
+        The caller is responsible for closing the returned response (and for verifying the content)
+        @param image - The image name
+        @param layer - The layer (in the format 'sha256:03....')
+        @return The response to read the layer from, or None
+    '''
+    def open_layer(self, image, layer):
+        response = self.access.get_raw_call_wrapper(url="/v2/" + image + "/blobs/" + layer)
+        if response and response.getcode() == 200:
+            return response
+        self.log.error("Failed to open layer %s for image %s" % (layer, image))
+        return None
 
     '''
         Downloads the specified layer from the specified image and stores it in the specified path
+        If the transfer is interrupted, it is resumed where it stopped (using a Range request) when the registry
+        supports it, or restarted from the beginning if it doesn't.
         @param image - The image name
         @param layer - The layer (in the format 'sha256:03....')
         @param file - The file to store the contents into
+        @param resume - If True and the file already contains the beginning of the layer, continue from there
+        @param sha1 - False if the sha1 of the layer won't be used (it is not computed)
+        @return The sha1 of the layer (True if it was not computed), or False if it could not be downloaded
+                (the partial file is kept)
     '''
-    def download_layer(self, image, layer, file):
-        response = self.access.get_raw_call_wrapper(url="/v2/" + image + "/blobs/" + layer)
-        # Write the contents into a file and verify the sha256 while we are at it
-        if response.getcode() == 200:
-            try:
-                hash_256 = hashlib.sha256()
-                hash_1 = hashlib.sha1()
-                with open(file, 'wb') as f:
-                    while True:
-                        chunk = response.read(self.CHUNK)
-                        if not chunk:
+    def download_layer(self, image, layer, file, resume=False, sha1=True):
+        # The digests are computed on another thread while the layer is read
+        digests = DigestPipeline(sha1)
+        sizer = ChunkSizer()
+        offset = 0
+        attempts = 0
+        segmented = False
+        try:
+            if resume and os.path.exists(file):
+                offset = self.__hash_file(file, digests)
+                self.log.info("Resuming download of layer %s for image %s at byte %d" % (layer, image, offset))
+            with open(file, 'ab' if offset else 'wb') as f:
+                while True:
+                    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+                    response = self.access.get_raw_call_wrapper(url="/v2/" + image + "/blobs/" + layer, headers=headers)
+                    code = response.getcode() if response else None
+                    if code == 416 and offset:
+                        # The partial content is already the complete layer
+                        break
+                    if code == 200 and offset:
+                        self.log.info("Registry ignored the range request for layer %s, downloading it again" % layer)
+                        f.seek(0)
+                        f.truncate()
+                        digests.close()
+                        digests = DigestPipeline(sha1)
+                        offset = 0
+                    elif code != 200 and not (code == 206 and self.__get_range_start(response) == offset):
+                        self.log.error("Failed to download layer %s for image %s, got: %s" % (layer, image, code))
+                        return False
+                    length = response.info().get('Content-Length')
+                    if not offset and not segmented and self.__use_segments(response, length):
+                        # Large layer, fetch it as concurrent ranges instead of this single response
+                        response.close()
+                        segmented = True
+                        f.truncate(int(length))
+                        if self.__download_segments(image, layer, file, int(length)):
+                            offset = self.__hash_file(file, digests)
                             break
-                        hash_256.update(chunk)
-                        hash_1.update(chunk)
-                        f.write(chunk)
-                expected_sha = layer.replace('sha256:', '')
-                found_sha = hash_256.hexdigest()
-                if found_sha == expected_sha:
-                    return hash_1.hexdigest()
-                else:
-                    self.log.error("Layer did not match expected sha. Expected " + expected_sha + " but got " +
-                                   found_sha)
-            except Exception as ex:
-                self.log.error(ex.message)
+                        self.log.warning("Segmented download of layer %s for image %s failed, downloading it as a "
+                                         "whole" % (layer, image))
+                        f.truncate(0)
+                        continue
+                    expected_end = offset + int(length) if length else None
+                    interrupted = False
+                    try:
+                        # Write the contents into a file and verify the sha256 while we are at it
+                        for nbytes in pump(response, f, digests, throttle=self.access.throttle_read, sizer=sizer):
+                            offset += nbytes
+                    except (socket.error, httplib.HTTPException) as ex:
+                        self.log.warning("Download of layer %s for image %s interrupted: %s" % (layer, image, ex))
+                        interrupted = True
+                    finally:
+                        response.close()
+                    if not interrupted and (expected_end is None or offset >= expected_end):
+                        break
+                    attempts += 1
+                    if attempts > self.resume_attempts:
+                        self.log.error("Giving up on layer %s for image %s after %d attempts" % (layer, image, attempts))
+                        return False
+                    f.flush()
+                    self.log.info("Resuming download of layer %s for image %s at byte %d" % (layer, image, offset))
+            expected_sha = layer.replace('sha256:', '')
+            found_sha = digests.sha256_hexdigest()
+            if found_sha == expected_sha:
+                return digests.sha1_hexdigest() or True
+            else:
+                self.log.error("Layer did not match expected sha. Expected " + expected_sha + " but got " +
+                               found_sha)
+                # The content is corrupt, don't let anyone resume from it
+                os.remove(file)
+        except Exception as ex:
+            self.log.error(ex.message)
+        finally:
+            digests.close()
         self.log.error("Failed to download layer %s for image %s" % (layer, image))
         return False
 
-    # Extracts the layers of the manifest file as well as the type
-    # Returns (type, layers)
-    def interpret_manifest(self, manif):
-        type = None
-        layers = []
+    '''
+        True if the layer of the response should rather be downloaded in segments
+    '''
+    def __use_segments(self, response, length):
+        return self.segments > 1 and length and int(length) >= self.segment_threshold \
+            and response.info().get('Accept-Ranges', '').lower() == 'bytes'
+
+    '''
+        Downloads a layer as concurrent ranges, each written at its place in the (preallocated) file
+        @param image - The image name
+        @param layer - The layer (in the format 'sha256:03....')
+        @param file - The file to store the contents into, already of the size of the layer
+        @param size - The size of the layer
+        @return True if all the segments were downloaded
+    '''
+    def __download_segments(self, image, layer, file, size):
+        self.log.info("Downloading layer %s for image %s (%d bytes) in %d segments" %
+                      (layer, image, size, self.segments))
+        segment_size = size // self.segments
+        errors = []
+        threads = []
+        for i in range(self.segments):
+            start = i * segment_size
+            end = size - 1 if i == self.segments - 1 else start + segment_size - 1
+            # Each segment has its own access, the access objects are not thread safe
+            t = threading.Thread(target=self.__download_segment,
+                                 args=(self.fork().access, image, layer, file, start, end, errors))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return not errors
+
+    def __download_segment(self, access, image, layer, file, start, end, errors):
+        offset = start
+        attempts = 0
+        sizer = ChunkSizer()
         try:
-            with open(manif, 'r') as m: js = json.load(m)
-            # V2-1 (https://docs.docker.com/registry/spec/manifest-v2-1)
-            if js['schemaVersion'] == 1:
-                # According to official spec: '"application/json" will also be accepted for schema1'
-                type = "application/json"
-                for layer in js['fsLayers']:
-                    layers.append(layer['blobSum'])
-            else:  # V2-2 (https://docs.docker.com/registry/spec/manifest-v2-2)
-                if 'mediaType' in js:
-                    type = js['mediaType']
-                else:
-                    type = 'application/vnd.docker.distribution.manifest.v2+json'
-                layers.append(js['config']['digest'])
-                for layer in js['layers']:
-                    # Don't try to grab foreign layers
-                    if 'mediaType' not in layer \
-                            or layer['mediaType'] != 'application/vnd.docker.image.rootfs.foreign.diff.tar.gzip':
-                        layers.append(layer['digest'])
-        except:
-            self.log.exception("Error reading Docker manifest %s:", manif)
-        return type, layers
+            with open(file, 'r+b') as f:
+                f.seek(start)
+                while offset <= end:
+                    response = access.get_raw_call_wrapper(url="/v2/" + image + "/blobs/" + layer,
+                                                           headers={'Range': 'bytes=%d-%d' % (offset, end)})
+                    if not response or response.getcode() != 206 or self.__get_range_start(response) != offset:
+                        errors.append("Range %d-%d of layer %s was refused" % (offset, end, layer))
+                        return
+                    try:
+                        for nbytes in pump(response, f, limit=end + 1 - offset, throttle=access.throttle_read,
+                                           sizer=sizer):
+                            offset += nbytes
+                    except (socket.error, httplib.HTTPException) as ex:
+                        self.log.warning("Range %d-%d of layer %s interrupted: %s" % (offset, end, layer, ex))
+                    finally:
+                        response.close()
+                    if offset <= end:
+                        attempts += 1
+                        if attempts > self.resume_attempts:
+                            errors.append("Giving up on range %d-%d of layer %s" % (offset, end, layer))
+                            return
+        except Exception as ex:
+            errors.append(str(ex))
+            self.log.error("Failed to download range %d-%d of layer %s: %s" % (start, end, layer, ex))
+
+    '''
+        Feeds the content of an existing file to the digests (read into reusable buffers)
+        @return The size of the file
+    '''
+    def __hash_file(self, file, digests):
+        size = 0
+        with open(file, 'rb') as f:
+            for nbytes in pump(f, pipeline=digests, ring=BufferRing()):
+                size += nbytes
+        return size
+
+    '''
+        Returns the first byte of a partial content response (or None)
+    '''
+    def __get_range_start(self, response):
+        content_range = response.info().get('Content-Range')
+        if content_range:
+            match = self.content_range_reg_ex.match(content_range)
+            if match:
+                return int(match.group(1))
+        return None
 
+    '''
+        Create a copy of this object for a worker.
+        The credentials and the current token are shared so the copy does not need to authenticate again.
+    '''
+    def fork(self):
+        clone = DockerRegistryAccess(url=self.url, username=self.username, password=self.password, method=self.method,
+                                     ignore_cert=self.ignore_cert)
+        if self.method == 'token':
+            clone.token_access = self.token_access.fork()
+            clone.access = clone.token_access
+        clone.set_segmented_download(self.segments, self.segment_threshold)
+        return clone
 
     '''
         Create a deep copy of this object
     '''
     def __deepcopy__(self, memo):
-        return DockerRegistryAccess(url=self.url, username=self.username, password=self.password, method=self.method,
-                                    ignore_cert=self.ignore_cert)
+        return self.fork()
 
@@ -1,15 +1,23 @@
 from HTTPAccess import HTTPAccess
+from DecompressingReader import ACCEPT_ENCODING
+from TokenCache import get_default_token_cache, get_key, get_granted_scopes, MAX_SCOPES_PER_TOKEN
+import re
+import urllib
 import urlparse
 import logging
 
 
 class DockerTokenAccess(HTTPAccess):
-    def __init__(self, url, username=None, password=None, ignore_cert=False, exlog=False):
+    def __init__(self, url, username=None, password=None, ignore_cert=False, exlog=False, token_cache=None):
         super(DockerTokenAccess, self).__init__(url=url, ignore_cert=ignore_cert, exlog=exlog) # Don't want basic auth
         self.log = logging.getLogger(__name__)
         self.username = username
         self.password = password
         self.token = None
+        # Tokens are shared by all the workers (and access objects) of the process
+        self.token_cache = token_cache or get_default_token_cache()
+        self.repository_path_reg_ex = re.compile(r'^/v2/(.+)/(?:manifests|blobs|tags)/')
+        self.challenge_param_reg_ex = re.compile(r'(\w+)="([^"]*)"')
 
 
     '''
@@ -24,6 +32,15 @@ class DockerTokenAccess(HTTPAccess):
     def has_token(self):
         return self.token
 
+    '''
+        Create a copy of this object for a worker, the copy starts with the current token
+    '''
+    def fork(self):
+        clone = DockerTokenAccess(url=self.url, username=self.username, password=self.password,
+                                  ignore_cert=self.ignore_cert, exlog=self.exlog, token_cache=self.token_cache)
+        clone.token = self.token
+        return clone
+
     '''
         Perform a GET request to the specified url (path) with the specified headers.
         Will try to get a token tries amount of times if the response sends the www-authenticate header.
@@ -33,8 +50,9 @@ class DockerTokenAccess(HTTPAccess):
         @param tries - The number of tries to try to reauth
     '''
     def get_code_and_msg_wrapper(self, url, headers=None, tries=1):
-        if not headers:
-            headers = {}
+        headers = dict(headers or {})
+        # The response is interpreted anyway, so it may come compressed
+        headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
         response = self.get_raw_call_wrapper(url, headers, tries)
         if response:
             return self.process_response(response), response
@@ -44,6 +62,8 @@ class DockerTokenAccess(HTTPAccess):
     '''
         Perform a GET request to the specified url (path) with the specified headers.
         Will try to get a token tries amount of times if the response sends the www-authenticate header.
+        Once the token server of the registry is known, a token for the scope of the request is taken from the
+        shared token cache before sending it, so the request is not refused first.
         Provides the raw response
         @param url = The url path to perform the request on
         @param headers - The headers to add to the call
@@ -53,42 +73,118 @@ class DockerTokenAccess(HTTPAccess):
         if not headers:
             headers = {}
         try:
-            headers = dict(headers.items() + self.__get_token_header().items())
-            response, stat = self.do_unprocessed_request(method='GET', path=url, headers=headers)
-            # If no token was provided or token is no longer valid, try to get a new token (limited number of tries)
-            if tries > 0 and response and 'www-authenticate'in response.headers:
-                self.token = self.__get_token(response.headers['www-authenticate'])
-                return self.get_raw_call_wrapper(url=url, headers=headers, tries=tries - 1)
-            return response
+            token = self.__get_cached_token(self.__get_scope(url))
+            if token:
+                self.token = token
+            while True:
+                request_headers = dict(headers.items() + self.__get_token_header().items())
+                response, stat = self.do_unprocessed_request(method='GET', path=url, headers=request_headers)
+                # If no token was provided or token is no longer valid, try to get a new token (limited number of tries)
+                if tries > 0 and response and 'www-authenticate' in response.headers:
+                    self.token = self.__get_token(response.headers['www-authenticate'], rejected=self.token)
+                    tries -= 1
+                    continue
+                return response
         except Exception as ex:
             self.log.error("While performing GET request for '%s':  %s" % (url, ex.message))
             return False
 
-    def __get_token_url(self, auth_header):
-        components = dict(x.split('=') for x in auth_header.split(','))
-        components = {k.lower(): v for k, v in components.items()}
-        url = components.pop('bearer realm', None)
-        if not url:
+    '''
+        Returns the scope of the token needed for the specified url (path), or None if it does not need one
+    '''
+    def __get_scope(self, url):
+        match = self.repository_path_reg_ex.match(url)
+        if match:
+            return 'repository:%s:pull' % match.group(1)
+        if url.startswith('/v2/_catalog'):
+            return 'registry:catalog:*'
+        return None
+
+    '''
+        Returns the cached token for the scope, or None if the token server of the registry is not known yet
+    '''
+    def __get_cached_token(self, scope):
+        challenge = self.token_cache.get_challenge(self.url)
+        if not challenge:
+            return None
+        realm, service = challenge
+        key = get_key(realm, service, scope, self.username, self.password)
+        return self.token_cache.get_token(key, lambda: self.__fetch_token(realm, service, [scope] if scope else []))
+
+    '''
+        Fetches the tokens needed to pull the specified images that are not cached yet (or about to expire)
+        Several scopes are requested per token, so this takes far fewer requests than one token per image
+        The token is only cached for the scopes it grants (when it says which, as a JWT), an image the token server
+        refused still gets its own token (and error) when a worker pulls it.
+        Does nothing until the token server of the registry is known (after the first challenge)
+        @param images - The names of the images
+    '''
+    def prefetch_tokens(self, images):
+        challenge = self.token_cache.get_challenge(self.url)
+        if not challenge:
+            return
+        realm, service = challenge
+        keys = []
+        scopes = {}
+        for image in images:
+            scope = 'repository:%s:pull' % image
+            key = get_key(realm, service, scope, self.username, self.password)
+            if key not in scopes:
+                keys.append(key)
+                scopes[key] = scope
+        missing = self.token_cache.get_missing(keys)
+        for i in range(0, len(missing), MAX_SCOPES_PER_TOKEN):
+            batch = missing[i:i + MAX_SCOPES_PER_TOKEN]
+            result = self.__fetch_token(realm, service, [scopes[key] for key in batch])
+            if result:
+                granted = get_granted_scopes(result[0])
+                if granted is not None:
+                    batch = [key for key in batch if scopes[key] in granted]
+                self.token_cache.put(batch, *result)
+
+    '''
+        Returns a token satisfying the www-authenticate challenge of the registry
+        @param auth_header - The www-authenticate header
+        @param rejected - The token the registry refused (if any), a new one is fetched
+    '''
+    def __get_token(self, auth_header, rejected=None):
+        if not auth_header.lower().startswith('bearer '):
+            self.log.error("www-authenticate header did not provide a valid URL for a token.")
+            return None
+        params = dict((k.lower(), v) for k, v in self.challenge_param_reg_ex.findall(auth_header[len('bearer '):]))
+        realm = params.get('realm')
+        if not realm:
             self.log.error("www-authenticate header did not provide a valid URL for a token.")
             return None
-        url = url.replace('"', '')
-        if len(components) > 0:
-            url = url + '?'
-            for key, value in components.iteritems():
-                url = url + str(key) + '=' + str(value).replace('"', '') + "&"
-            url = url[:-1]
-        return url
+        service = params.get('service')
+        scope = params.get('scope')
+        self.token_cache.set_challenge(self.url, realm, service)
+        key = get_key(realm, service, scope, self.username, self.password)
+        return self.token_cache.get_token(key, lambda: self.__fetch_token(realm, service, [scope] if scope else []),
+                                          rejected)
 
-    def __get_token(self, auth_header):
-        url = self.__get_token_url(auth_header)
-        if url:
-            scheme, netloc, path, query, frag = urlparse.urlsplit(url)
-            # If the user provided credentials, use them to get the token
-            access = HTTPAccess(url=scheme + "://" + netloc, username=self.username, password=self.password,
-                                ignore_cert=self.ignore_cert)
-            token_response = access.dorequest('GET', path + '?' + query)
-            if token_response and token_response['token']:
-                return token_response['token']
+    '''
+        Requests a token from the token server
+        @param scopes - The scopes the token is requested for (sent as repeated scope parameters)
+        @return (token, expires_in, issued_at) or None
+    '''
+    def __fetch_token(self, realm, service, scopes):
+        params = []
+        if service:
+            params.append(('service', service))
+        for scope in scopes:
+            params.append(('scope', scope))
+        scheme, netloc, path, query, frag = urlparse.urlsplit(realm)
+        query = '&'.join(q for q in (query, urllib.urlencode(params)) if q)
+        # If the user provided credentials, use them to get the token
+        access = HTTPAccess(url=scheme + "://" + netloc, username=self.username, password=self.password,
+                            ignore_cert=self.ignore_cert)
+        token_response = access.dorequest('GET', path + ('?' + query if query else ''))
+        if token_response:
+            # 'access_token' is the OAuth2 compatible name of the token
+            token = token_response.get('token') or token_response.get('access_token')
+            if token:
+                return token, token_response.get('expires_in'), token_response.get('issued_at')
         return None
 
     def __get_token_header(self):
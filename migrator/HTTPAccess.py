@@ -7,12 +7,75 @@ import StringIO
 import xml.etree.ElementTree as ET
 import urlparse
 import logging
-import mmap
 import os
+import threading
+import time
+from ConnectionPool import get_default_pool, KeepAliveHTTPHandler, KeepAliveHTTPSHandler
+from StreamBody import StreamBody
+from RetryPolicy import get_default_policy, HOST_DOWN_STATUSES
+from BandwidthGovernor import get_default_governor, READ, WRITE
+from DecompressingReader import decode_response, ACCEPT_ENCODING
+
+_openers_lock = threading.Lock()
+_openers = {}
+_observers = []
+
+'''
+    Returns the opener (and the TLS context behind it) shared by every access object with the same TLS
+    configuration and connection pool. Building a TLS context loads the CA store, so it is only done once
+    per configuration instead of once per access object (and worker clone).
+    @param ignore_cert - True if certificate errors should be ignored
+    @param pool - The connection pool the opener should use
+'''
+def get_shared_opener(ignore_cert, pool):
+    key = (bool(ignore_cert), pool)
+    with _openers_lock:
+        opener = _openers.get(key)
+        if not opener:
+            ctx = ssl.create_default_context()
+            if ignore_cert:
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+            opener = urllib2.build_opener(KeepAliveHTTPHandler(pool), KeepAliveHTTPSHandler(pool, context=ctx),
+                                          CleanAuthenticationHeadersOnRedirectHandler)
+            _openers[key] = opener
+        return opener
+
+'''
+    Registers an object notified of the outcome of every request: observer.on_response(status, elapsed)
+    status is None on connection errors and elapsed is the time (in seconds) it took to get the response headers
+'''
+def add_request_observer(observer):
+    _observers.append(observer)
+
+def remove_request_observer(observer):
+    if observer in _observers:
+        _observers.remove(observer)
+
+def notify_request_observers(status, elapsed):
+    for observer in list(_observers):
+        observer.on_response(status, elapsed)
+
+'''
+    Reads what is left of the body of a response and closes it, so its keep-alive connection goes back to the pool
+    (a response closed before its end loses its connection). The headers of the response remain available.
+    @param resp - The response (or HTTPError) of a request, anything else is ignored
+'''
+def release_response(resp):
+    if not hasattr(resp, 'read'):
+        return
+    try:
+        while resp.read(64 * 1024):
+            pass
+    except Exception:
+        pass
+    finally:
+        resp.close()
 
 
 class HTTPAccess(object):
-    def __init__(self, url, username=None, password=None, ignore_cert=False, exlog=False):
+    def __init__(self, url, username=None, password=None, ignore_cert=False, exlog=False, pool=None,
+                 retry_policy=None, governor=None):
         self.log = logging.getLogger(__name__)
         self.url = url.rstrip('/')
 
@@ -22,17 +85,15 @@ class HTTPAccess(object):
         self.json = re.compile(r'^application/(?:[^;]+\+)?json(?:;.+)?$')
         self.xml = re.compile(r'^application/(?:[^;]+\+)?xml(?:;.+)?$')
         self.exlog = exlog
-        # Install custom redirect handler
-        # Install custom handlers for handling SSL (ignore certs) and redirects
-        opener=None
-        if self.ignore_cert:
-            ctx = ssl.create_default_context()
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
-            opener = urllib2.build_opener(urllib2.HTTPSHandler(context=ctx), CleanAuthenticationHeadersOnRedirectHandler)
-        else:
-            opener = urllib2.build_opener(CleanAuthenticationHeadersOnRedirectHandler)
-        urllib2.install_opener(opener)
+        # Connections are kept alive and shared (per host) by all the access objects using the same pool
+        self.pool = pool or get_default_pool()
+        # Custom handlers for handling SSL (ignore certs), keep-alive connections and redirects.
+        # The opener is used directly (not installed globally) so access objects can't step on each other.
+        self.opener = get_shared_opener(self.ignore_cert, self.pool)
+        # Transient failures are retried, and requests to a host that is down wait for it (shared by all workers)
+        self.retry_policy = retry_policy or get_default_policy()
+        # Transfers to/from the endpoint are kept within the bandwidth limits (shared by all workers)
+        self.governor = governor or get_default_governor()
         # Set up the connection
         headers = {'User-Agent': 'Docker registry to Artifactory migrator'}
         if username and password:
@@ -44,6 +105,26 @@ class HTTPAccess(object):
     def get_username(self):
         return self.username
 
+    '''
+        Returns the handshake/reuse counters of the connection pool used by this access
+    '''
+    def get_connection_stats(self):
+        return self.pool.get_stats()
+
+    '''
+        Blocks until nbytes read from this endpoint fit in the bandwidth limits
+        @param nbytes - The number of bytes read (or about to be)
+    '''
+    def throttle_read(self, nbytes):
+        self.governor.throttle(READ, self.connection[1].lower(), nbytes)
+
+    '''
+        Blocks until nbytes written to this endpoint fit in the bandwidth limits
+        @param nbytes - The number of bytes about to be written
+    '''
+    def throttle_write(self, nbytes):
+        self.governor.throttle(WRITE, self.connection[1].lower(), nbytes)
+
     def get_call_wrapper(self, arg):
         try:
             response = self.dorequest('GET', arg)
@@ -62,12 +143,13 @@ class HTTPAccess(object):
     '''
         Perform a GET request to the specified url (path) with the specified headers.
         Interprets the result into a more python friendly form. Includes 
+        The response may be compressed (gzip/deflate), it is decompressed while being interpreted.
         @param url - The url path to perform the request on
         @param headers - The headers to add to the call
     '''
     def get_code_and_msg_wrapper(self, url, headers=None):
-        if not headers:
-            headers = {}
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
         response = self.get_raw_call_wrapper(url, headers)
         if response:
             return self.process_response(response), response
@@ -92,10 +174,10 @@ class HTTPAccess(object):
 
 
 
-    # Helper REST method
+    # Helper REST method, the response may be compressed (gzip/deflate) as it is interpreted anyway
     def dorequest(self, method, path, body=None, headers=None):
-        if not headers:
-            headers = {}
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
         resp, stat = self.do_unprocessed_request(method, path, body, headers)
         if resp and resp.info():
             ctype = resp.info().get('Content-Type', 'application/octet-stream')
@@ -103,9 +185,10 @@ class HTTPAccess(object):
             msg = "Unable to " + method + " " + path + ": " + str(stat) + "."
             raise Exception(msg)
         try:
-            if self.json.match(ctype) != None: msg = json.load(resp)
-            elif self.xml.match(ctype) != None: msg = ET.parse(resp)
-            else: msg = resp.read()
+            body = decode_response(resp)
+            if self.json.match(ctype) != None: msg = json.load(body)
+            elif self.xml.match(ctype) != None: msg = ET.parse(body)
+            else: msg = body.read()
         except: pass
         return msg
 
@@ -128,10 +211,9 @@ class HTTPAccess(object):
         scheme, host, rootpath, extraheaders = self.connection
         headers.update(extraheaders)
         url = urlparse.urlunsplit((scheme, host, rootpath + path, '', ''))
-        req = MethodRequest(url, body, headers, method=method)
         self.log.info("Sending %s request to %s.", method, url)
         try:
-            resp = urllib2.urlopen(req)
+            resp = self.open_with_retries(method, lambda: MethodRequest(url, body, headers, method=method))
             stat = resp.getcode()
         except urllib2.HTTPError as ex:
             if self.exlog:
@@ -145,17 +227,58 @@ class HTTPAccess(object):
             resp = ex
         return resp, stat
 
+    '''
+        Opens the request built by make_request, sending it again for as long as the retry policy allows it
+        The error of the last attempt (HTTPError, URLError) is raised, as opener.open would
+        @param method - The HTTP method of the request
+        @param make_request - Callable building the request, called for every attempt
+        @param replayable - False if the body of the request can't be sent again
+    '''
+    def open_with_retries(self, method, make_request, replayable=True):
+        breaker = self.retry_policy.get_breaker(self.connection[1])
+        attempt = 0
+        while True:
+            breaker.before_request()
+            req = make_request()
+            start = time.time()
+            try:
+                resp = self.opener.open(req)
+                breaker.record_success()
+                notify_request_observers(resp.getcode(), time.time() - start)
+                return resp
+            except urllib2.HTTPError as ex:
+                error, status, retry_after = ex, ex.code, ex.info().get('Retry-After')
+            except urllib2.URLError as ex:
+                error, status, retry_after = ex, None, None
+            except:
+                breaker.record_abandon()
+                raise
+            notify_request_observers(status, time.time() - start)
+            if status is None or status in HOST_DOWN_STATUSES:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            delay = self.retry_policy.get_delay(method, status, attempt, retry_after, replayable)
+            if delay is None:
+                raise error
+            self.log.warning("%s request to %s failed (%s), retrying in %.1f seconds."
+                             % (method, req.get_full_url(), status or error.reason, delay))
+            time.sleep(delay)
+            attempt += 1
+
     '''
         Interprets a valid response into a more python friendly form
+        A compressed (gzip/deflate) response is decompressed as it is read
     '''
     def process_response(self, resp):
         msg = False
         if resp and resp.info():
             ctype = resp.info().get('Content-Type', 'application/octet-stream')
         try:
-            if self.json.match(ctype) != None: msg = json.load(resp)
-            elif self.xml.match(ctype) != None: msg = ET.parse(resp)
-            else: msg = resp.read()
+            body = decode_response(resp)
+            if self.json.match(ctype) != None: msg = json.load(body)
+            elif self.xml.match(ctype) != None: msg = ET.parse(body)
+            else: msg = body.read()
         except: pass
         return msg
 
@@ -176,36 +299,73 @@ class HTTPAccess(object):
         @param headers - Any optional headers
     '''
     def deployFileByStream(self, path, file_path, headers=None):
+        try:
+            with open(file_path, 'rb') as f:
+                return self.deployStream(path, f, os.fstat(f.fileno()).st_size, headers)
+        except BaseException as ex:
+            self.log.exception("Error uploading artifact:")
+            return str(ex)
+
+    '''
+        Deploys content produced on the fly without storing it first
+        The content is sent with the provided length or, if the length is unknown, with chunked transfer encoding
+        @param path - The path to deploy to
+        @param stream - The producer of the content: a file like object, an iterator of strings or a string
+        @param length - (optional) The number of bytes the stream will produce
+        @param headers - Any optional headers
+    '''
+    def deployStream(self, path, stream, length=None, headers=None):
+        resp, stat = self.sendStream('PUT', path, stream, length, headers)
+        release_response(resp)
+        return stat
+
+    '''
+        Sends content produced on the fly as the body of a request, like deployStream but with any method
+        @param method - The HTTP method (e.g. PUT or PATCH)
+        @param path - The path (and query) to send the request to
+        @param stream - The producer of the content: a file like object, an iterator of strings or a string
+        @param length - (optional) The number of bytes the stream will produce
+        @param headers - Any optional headers
+        @return (response, status), the response is None if no response was received
+    '''
+    def sendStream(self, method, path, stream, length=None, headers=None):
         if not headers:
             headers = {}
-        stat = None
+        resp, stat = None, None
         artifact_headers = {'Content-Type': 'application/octet-stream'}
-        mmapped_file_as_string = None
+        artifact_headers.update(headers)
+        scheme, host, rootpath, extraheaders = self.connection
+        artifact_headers.update(extraheaders)
+        url = urlparse.urlunsplit((scheme, host, rootpath + path, '', ''))
+        # Only content that can be produced again (a string or a seekable file) can be sent again
+        position = None
+        if hasattr(stream, 'seek') and hasattr(stream, 'tell'):
+            try:
+                position = stream.tell()
+            except IOError:
+                position = None
+        replayable = isinstance(stream, basestring) or position is not None
+
+        def make_request():
+            if position is not None:
+                stream.seek(position)
+            return MethodRequest(url, StreamBody(stream, length, throttle=self.throttle_write, replayable=replayable),
+                                 artifact_headers, method=method)
+
+        self.log.info("Uploading artifact to %s.", path)
         try:
-            artifact_headers['Content-Length'] = str(os.stat(file_path).st_size)
-            artifact_headers.update(headers)
-            with open(file_path, 'rb') as f:
-                self.log.info("Uploading artifact to %s.", path)
-                mmapped_file_as_string = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-                scheme, host, rootpath, extraheaders = self.connection
-                artifact_headers.update(extraheaders)
-                url = urlparse.urlunsplit((scheme, host, rootpath + path, '', ''))
-                req = PutRequest(url, mmapped_file_as_string, artifact_headers)
-                try:
-                    stat = urllib2.urlopen(req).getcode()
-                except urllib2.HTTPError as ex:
-                    msg = "Error uploading artifact:\n%s"
-                    self.log.exception(msg, ex.read())
-                    stat = ex.code
-                except urllib2.URLError as ex:
-                    self.log.exception("Error uploading artifact:")
-                    stat = ex.reason
+            resp = self.open_with_retries(method, make_request, replayable)
+            stat = resp.getcode()
+        except urllib2.HTTPError as ex:
+            self.log.exception("Error uploading artifact:\n%s", ex.read())
+            resp, stat = ex, ex.code
+        except urllib2.URLError as ex:
+            self.log.exception("Error uploading artifact:")
+            stat = ex.reason
         except BaseException as ex:
             self.log.exception("Error uploading artifact:")
             stat = str(ex)
-        if mmapped_file_as_string:
-            mmapped_file_as_string.close()
-        return stat
+        return resp, stat
 
 
 
@@ -0,0 +1,47 @@
+from DigestPipeline import DigestPipeline
+
+'''
+    File like wrapper that computes the sha256 and sha1 sums of everything read through it
+    The sums are computed on another thread (see DigestPipeline) while the consumer handles the data.
+    @param fp - The file like object to read from
+    @param length - (optional) The number of bytes expected. Reaching the end of fp before that is an error,
+                    so a truncated source aborts whatever is consuming this reader.
+    @param throttle - (optional) Callable invoked with the size of every block read (bandwidth limits)
+    @param sha1 - False if the sha1 won't be used (it is not computed)
+'''
+class HashingReader(object):
+    def __init__(self, fp, length=None, throttle=None, sha1=True):
+        self.fp = fp
+        self.throttle = throttle
+        self.length = length
+        self.count = 0
+        self.digests = DigestPipeline(sha1)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.fp.read()
+        else:
+            data = self.fp.read(size)
+        if data:
+            if self.throttle:
+                self.throttle(len(data))
+            self.count += len(data)
+            self.digests.update(data)
+        elif self.length is not None and self.count < self.length:
+            raise IOError("Stream ended after %d of %d bytes." % (self.count, self.length))
+        return data
+
+    '''
+        Stops computing the sums (they are available until then)
+    '''
+    def close(self):
+        self.digests.close()
+
+    def sha256_hexdigest(self):
+        return self.digests.sha256_hexdigest()
+
+    '''
+        Returns the sha1, or None if it is not computed
+    '''
+    def sha1_hexdigest(self):
+        return self.digests.sha1_hexdigest()
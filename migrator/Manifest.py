@@ -0,0 +1,109 @@
+import hashlib
+import json
+from collections import OrderedDict
+
+# Globals
+MANIFEST_V1 = 'application/vnd.docker.distribution.manifest.v1+json'
+MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+MANIFEST_LIST_V2 = 'application/vnd.docker.distribution.manifest.list.v2+json'
+OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+OCI_CONFIG = 'application/vnd.oci.image.config.v1+json'
+# Manifests referencing other manifests (one per platform) instead of layers
+MANIFEST_LIST_TYPES = (MANIFEST_LIST_V2, OCI_INDEX)
+# Layers that are not distributed by the registry (and must not be copied)
+FOREIGN_LAYER_TYPES = (
+    'application/vnd.docker.image.rootfs.foreign.diff.tar.gzip',
+    'application/vnd.oci.image.layer.nondistributable.v1.tar',
+    'application/vnd.oci.image.layer.nondistributable.v1.tar+gzip',
+    'application/vnd.oci.image.layer.nondistributable.v1.tar+zstd',
+)
+
+'''
+    An image manifest held in memory: its exact bytes (deployed as is), its digest and its parsed content
+    The content is parsed, and the layer plan computed, once when the manifest is created.
+
+    @param contents - The bytes of the manifest
+    @raise ValueError - If the contents are not a manifest
+'''
+class Manifest(object):
+    def __init__(self, contents):
+        self.contents = contents
+        self.digest = 'sha256:' + hashlib.sha256(contents).hexdigest()
+        self.js = json.loads(contents, object_pairs_hook=OrderedDict)
+        try:
+            self.type = self.__get_type()
+            self.layers = self.__get_layers()
+            self.children = self.__get_children()
+        except (KeyError, TypeError, AttributeError) as ex:
+            raise ValueError("Not a manifest, missing or invalid %s." % ex)
+
+    '''
+        True if this is a manifest list or an OCI index
+    '''
+    def is_list(self):
+        return self.type in MANIFEST_LIST_TYPES
+
+    '''
+        Returns the blobs (config first, then the layers) to migrate for this manifest
+        Each blob is listed once (schema1 manifests repeat the same empty layer many times) and foreign layers
+        are left out. Empty for a manifest list.
+        @return List of digests (in the format 'sha256:03....')
+    '''
+    def get_layers(self):
+        return self.layers
+
+    '''
+        Returns the child manifests of a manifest list (empty for an image manifest)
+        @return List of (digest, media type, platform) of the children (the platform is a dictionary, possibly empty)
+    '''
+    def get_children(self):
+        return self.children
+
+    '''
+        Returns a copy of this manifest list limited to the specified children
+        @param digests - The digests of the children to keep
+    '''
+    def select_children(self, digests):
+        js = OrderedDict(self.js)
+        js['manifests'] = [child for child in self.js['manifests'] if child['digest'] in digests]
+        return Manifest(json.dumps(js, indent=3, separators=(',', ': ')))
+
+    def __get_type(self):
+        js = self.js
+        # V2-1 (https://docs.docker.com/registry/spec/manifest-v2-1)
+        if js.get('schemaVersion') == 1:
+            # According to official spec: '"application/json" will also be accepted for schema1'
+            return "application/json"
+        if 'mediaType' in js:
+            return js['mediaType']
+        if 'manifests' in js:
+            return OCI_INDEX
+        if js['config'].get('mediaType') == OCI_CONFIG:
+            return OCI_MANIFEST
+        # V2-2 (https://docs.docker.com/registry/spec/manifest-v2-2)
+        return MANIFEST_V2
+
+    def __get_layers(self):
+        js = self.js
+        if js.get('schemaVersion') == 1:
+            blobs = [layer['blobSum'] for layer in js['fsLayers']]
+        elif self.is_list():
+            blobs = []
+        else:
+            # Don't try to grab foreign layers
+            blobs = [js['config']['digest']] + [layer['digest'] for layer in js['layers']
+                                                if layer.get('mediaType') not in FOREIGN_LAYER_TYPES]
+        layers = []
+        seen = set()
+        for blob in blobs:
+            if blob not in seen:
+                seen.add(blob)
+                layers.append(blob)
+        return layers
+
+    def __get_children(self):
+        if not self.is_list():
+            return []
+        return [(child['digest'], child.get('mediaType'), child.get('platform') or {})
+                for child in self.js['manifests']]
@@ -1,10 +1,31 @@
+import itertools
 import logging
-import copy
+import os
+import threading
+import time
 from threading import Thread
 from Queue import Queue
+from HashingReader import HashingReader
+from ConcurrencyController import ConcurrencyController, DEFAULT_INTERVAL
+from HTTPAccess import add_request_observer, remove_request_observer
+from TransferRegistry import TransferRegistry, OWNER, DONE, FAILED
+from DigestSet import DigestSet
+
+# Workers spend their time waiting on the network, a small stack keeps hundreds of them cheap
+WORKER_STACK_SIZE = 512 * 1024
+# Sub directory of the work directory where interrupted layer downloads are kept for the next run
+PARTIAL_DIR = 'partial'
+# How often (in seconds) tokens are prefetched for the images at the head of the queue
+TOKEN_PREFETCH_INTERVAL = 5
+# Number of queued image/tags (per worker) tokens are prefetched for
+TOKEN_PREFETCH_DEPTH = 4
+# Number of child manifests of a manifest list fetched concurrently (by each worker)
+CHILD_MANIFEST_FETCHES = 4
 
 class Migrator(object):
-    def __init__(self, source_registry, artifactory_access, work_queue, workers, overwrite, dir_path):
+    def __init__(self, source_registry, artifactory_access, work_queue, workers, overwrite, dir_path,
+                 stream_layers=False, max_workers=None, blob_cache=None, digest_index=None, target_tags=None,
+                 platforms=None):
         self.log = logging.getLogger(__name__)
         self.source = source_registry
         self.target = artifactory_access
@@ -13,17 +34,118 @@ class Migrator(object):
         self.skipped_queue = Queue()
         self.overwrite = overwrite
         self.workers = workers
+        # With a max_workers above workers, the number of concurrent workers adapts between 1 and max_workers
+        if max_workers and max_workers > workers:
+            self.controller = ConcurrencyController(workers, 1, max_workers)
+        else:
+            self.controller = ConcurrencyController(workers, workers, workers)
         self.dir_path = dir_path
+        self.partial_dir = os.path.join(dir_path, PARTIAL_DIR)
+        self.stream_layers = stream_layers
+        # Layers shared by several images/tags are transferred once, by whichever worker gets to them first
+        self.layers = TransferRegistry()
+        # Tags of an image pointing at the same manifest (aliases) are migrated once, the others only get the manifest
+        self.images = TransferRegistry()
+        # Optional persistent cache of downloaded layers (BlobCache), checked before the source
+        self.blob_cache = blob_cache
+        # Optional persistent sha256 -> sha1 index (DigestIndex), allows sha1 checksum deploys without downloading
+        self.digest_index = digest_index
+        # Layers known (from bulk lookups) to be stored in, or missing from, the target
+        # A layer is only known to be missing as of its lookup, it may since have been added by another run (or by
+        # replication). It is then transferred again instead of checksum deployed, which is redundant but correct.
+        self.present_layers = DigestSet()
+        self.absent_layers = DigestSet()
+        # Image each layer known to be in the target is stored under, to mount it from (V2 push API)
+        self.layer_images = {}
+        # Optional tags of the target listed once per image (TargetTags), the manifest HEAD is only a fallback
+        self.target_tags = target_tags
+        # Optional (os, architecture, variant) platforms (see parse_platforms) the manifest lists are limited to
+        self.platforms = platforms
+        # Set by start, stops the token prefetcher and the concurrency monitor once the migration is over
+        self.done = None
 
     '''
         Iterates over the Queue until all images have been uploaded (or have failed to upload)
     '''
     def migrate(self):
-        for i in range(self.workers):
-            t = Thread(target=self.__worker, args=(i,))
-            t.daemon = True
-            t.start()
+        self.start()
+        self.wait()
+
+    '''
+        Starts the workers, which migrate the image/tags as they are put in the Queue
+    '''
+    def start(self):
+        try:
+            previous_stack_size = threading.stack_size(WORKER_STACK_SIZE)
+        except (ValueError, threading.ThreadError):
+            self.log.info("Unable to change the worker stack size, using the default.")
+            previous_stack_size = None
+        try:
+            # Enough workers are started for the highest concurrency, the controller decides how many are active
+            for i in range(self.controller.maximum):
+                t = Thread(target=self.__worker, args=(i,))
+                t.daemon = True
+                t.start()
+        finally:
+            if previous_stack_size is not None:
+                threading.stack_size(previous_stack_size)
+        self.done = threading.Event()
+        prefetcher = Thread(target=self.__prefetch_tokens, args=(self.done,))
+        prefetcher.daemon = True
+        prefetcher.start()
+        if self.controller.is_adaptive():
+            add_request_observer(self.controller)
+            monitor = Thread(target=self.__adjust_concurrency, args=(self.done,))
+            monitor.daemon = True
+            monitor.start()
+
+    '''
+        Waits until all the image/tags put in the Queue have been uploaded (or have failed to upload)
+        Only call once nothing more is put in the Queue, the workers are idle as soon as it is empty.
+    '''
+    def wait(self):
         self.work_queue.join()
+        self.done.set()
+        if self.controller.is_adaptive():
+            remove_request_observer(self.controller)
+        counts = self.layers.get_counts()
+        self.log.info("Layers transferred: %d, failed: %d." % (counts[DONE], counts[FAILED]))
+        self.log.info("Distinct manifests migrated: %d." % self.images.get_counts()[DONE])
+        if self.blob_cache:
+            self.log.info("Layer cache: %(hits)d hits, %(misses)d misses, %(layers)d layers (%(size)d bytes)."
+                          % self.blob_cache.get_stats())
+
+    '''
+        Periodically lets the controller adjust the number of concurrent workers until done is set
+    '''
+    def __adjust_concurrency(self, done):
+        last = time.time()
+        while not done.wait(DEFAULT_INTERVAL):
+            now = time.time()
+            self.controller.adjust(now - last)
+            last = now
+
+    '''
+        Periodically fetches the tokens needed by the images at the head of the queue until done is set,
+        so the workers find them in the token cache instead of waiting for the token server
+    '''
+    def __prefetch_tokens(self, done):
+        source = self.source.fork()
+        depth = self.controller.maximum * TOKEN_PREFETCH_DEPTH
+        while True:
+            with self.work_queue.mutex:
+                upcoming = list(itertools.islice(self.work_queue.queue, depth))
+            images = []
+            for image, tag in upcoming:
+                if image not in images:
+                    images.append(image)
+            if images:
+                try:
+                    source.prefetch_tokens(images)
+                except Exception as ex:
+                    self.log.info("Unable to prefetch tokens: %s" % ex)
+            if done.wait(TOKEN_PREFETCH_INTERVAL):
+                return
 
     '''
         Consumes image/tags that need to be uploaded from Queue until Queue is empty
@@ -31,15 +153,21 @@ class Migrator(object):
         @param idx - The index (or ID) of this worker. Should be unique across all concurrent workers.
     '''
     def __worker(self, idx):
-        # The endpoint resources are not thread safe, make deep copies
-        source = copy.deepcopy(self.source)
-        target = copy.deepcopy(self.target)
+        # The endpoint resources are not thread safe, make (cheap) copies
+        source = self.source.fork()
+        target = self.target.fork()
         while True:
             image, tag = self.work_queue.get()
+            # Only workers with an image/tag to migrate take a slot, idle ones don't count as load
+            self.controller.acquire()
             failure = True
+            migrated = False
             try:
-                if self.overwrite or not target.image_exists(image, tag):
+                if self.overwrite or not self.__image_exists(target, image, tag):
                     failure = not self.__upload_image(source, target, image, tag, idx)
+                    migrated = not failure
+                    if migrated and self.target_tags:
+                        self.target_tags.add(image, tag)
                 else:  # Image already exists and we should not overwrite it
                     failure = False
                     self.skipped_queue.put((image, tag))
@@ -47,10 +175,26 @@ class Migrator(object):
                 self.log.error("Upload of %s/%s failed." % (image, tag))
             if failure:
                 self.failure_queue.put((image, tag))
+            # Only migrated image/tags count towards the throughput, fast failures and skips say nothing about it
+            self.controller.release(completed=migrated)
             self.work_queue.task_done()
 
+    '''
+        Checks whether the image/tag is in the target, from the tags listed for the image when available
+        @target - The target Artifactory instance
+        @image - The image name
+        @tag - The tag name
+    '''
+    def __image_exists(self, target, image, tag):
+        exists = self.target_tags.has_tag(image, tag, target) if self.target_tags else None
+        if exists is None:
+            exists = target.image_exists(image, tag)
+        return exists
+
     '''
         Attempts to upload the specified image from the source to the target
+        A tag whose manifest (identified by its digest) was already migrated for another tag of the image is an alias:
+        only its manifest is deployed. If that fails, the tag is migrated fully.
         @source - The source registry
         @target - The target Artifactory instance
         @image - The image name
@@ -58,46 +202,380 @@ class Migrator(object):
     '''
     def __upload_image(self, source, target, image, tag, idx):
         self.log.info("Uploading image %s/%s..." % (image, tag))
-        layer_file = "%s/layer%d.out" % (self.dir_path, idx)
-        manifest_file = "%s/manifest%d.json" % (self.dir_path, idx)
         # Get the manifest
-        if source.download_manifest(image, tag, manifest_file):
-            # Read in all the layers and try to deploy them
-            type, layers = source.interpret_manifest(manifest_file)
-            for layer in layers:
-                sha2 = layer.replace('sha256:', '')
-                # Try to perform a sha2 checksum deploy to avoid downloading the layer from source
-                if not target.checksum_deploy_sha2(image, tag, sha2):
-                    # Sha2 checksum failed, download the file
-                    sha1 = source.download_layer(image, layer, layer_file)
-                    if sha1:
-                        # Try a sha1 checksum deploy to avoid upload to target
-                        if not target.checksum_deploy_sha1(image, tag, sha2, sha1):
-                            # All checksum deploys failed, perform an actual upload
-                            if not target.upload_layer(image, tag, sha2, layer_file):
-                                self.log.error("Unable to upload layer %s for %s/%s" % (layer, image, tag))
-                                return False
-                    else:
-                        self.log.error("Unable to get layer %s for %s/%s..." % (layer, image, tag))
-                        return False
-            # Finished uploading all layers, upload the manifest
-            if not target.upload_manifest(image, tag, type, manifest_file):
-                self.log.error("Unable to deploy manifest for %s/%s..." % (image, tag))
-                return False
+        manifest = source.get_manifest(image, tag)
+        if not manifest:
+            self.log.error("Unable to get manifest for %s/%s..." % (image, tag))
+            return False
+        key = (image, manifest.digest)
+        state, deployed = self.images.begin(key)
+        if state == DONE:
+            if target.upload_manifest_from_stream(image, tag, deployed.type, deployed.contents):
+                self.log.info("Deployed %s/%s as an alias of the same manifest" % (image, tag))
+                return True
+            self.log.warning("Unable to deploy %s/%s as an alias, migrating it fully" % (image, tag))
+            return bool(self.__transfer_image(source, target, image, tag, manifest, idx))
+        if state != OWNER:
+            return bool(self.__transfer_image(source, target, image, tag, manifest, idx))
+        deployed = None
+        try:
+            deployed = self.__transfer_image(source, target, image, tag, manifest, idx)
+        finally:
+            self.images.finish(key, bool(deployed), deployed)
+        return bool(deployed)
+
+    '''
+        Migrates the layers of the image, then deploys its manifest
+        @param manifest - The Manifest of the image/tag
+        @return The deployed Manifest (kept for the aliases of the tag), or None if the image could not be migrated
+    '''
+    def __transfer_image(self, source, target, image, tag, manifest, idx):
+        layer_file = "%s/layer%d.out" % (self.dir_path, idx)
+        if manifest.is_list():
+            return self.__upload_manifest_list(source, target, image, tag, manifest, layer_file)
+        # Deploy each layer of the plan (every layer only once)
+        layers = manifest.get_layers()
+        self.__classify_layers(target, layers)
+        for layer in layers:
+            if not self.__migrate_layer(source, target, image, tag, layer, layer_file):
+                return None
+        # Finished uploading all layers, upload the manifest
+        if not target.upload_manifest_from_stream(image, tag, manifest.type, manifest.contents):
+            self.log.error("Unable to deploy manifest for %s/%s..." % (image, tag))
+            return None
+        return manifest
+
+    '''
+        Uploads a multi platform image (manifest list or OCI index)
+        The child manifests of the selected platforms are fetched concurrently, the layers they share are migrated
+        once, and the children are uploaded (by digest) before the list, so the list never references missing
+        manifests. The list is rewritten when some of its platforms are filtered out.
+        @param manifest - The Manifest of the list
+        @return The deployed Manifest of the list, or None if the image could not be migrated
+    '''
+    def __upload_manifest_list(self, source, target, image, tag, manifest, layer_file):
+        children = manifest.get_children()
+        selected = [child for child in children if self.__is_selected_platform(child[2])]
+        if not selected:
+            self.log.error("None of the platforms of %s/%s is selected" % (image, tag))
+            return None
+        if len(selected) < len(children):
+            self.log.info("Migrating %d of the %d platforms of %s/%s" % (len(selected), len(children), image, tag))
+            manifest = manifest.select_children([child[0] for child in selected])
+        child_manifests = self.__get_child_manifests(source, image, [child[0] for child in selected])
+        if not child_manifests:
+            self.log.error("Unable to get the platform manifests of %s/%s..." % (image, tag))
+            return None
+        layers = []
+        for (digest, child_type, platform), child in zip(selected, child_manifests):
+            if child.is_list():
+                self.log.error("Unsupported manifest %s in %s/%s" % (digest, image, tag))
+                return None
+            # Layers shared by several platforms are only migrated once
+            for layer in child.get_layers():
+                if layer not in layers:
+                    layers.append(layer)
+        self.__classify_layers(target, layers)
+        for layer in layers:
+            if not self.__migrate_layer(source, target, image, tag, layer, layer_file):
+                return None
+        for (digest, child_type, platform), child in zip(selected, child_manifests):
+            if not target.upload_manifest_from_stream(image, digest, child_type or child.type, child.contents):
+                self.log.error("Unable to deploy manifest %s for %s/%s..." % (digest, image, tag))
+                return None
+        if not target.upload_manifest_from_stream(image, tag, manifest.type, manifest.contents):
+            self.log.error("Unable to deploy manifest for %s/%s..." % (image, tag))
+            return None
+        return manifest
+
+    '''
+        True if the platform (of a manifest list entry) is one of the selected platforms (or none were selected)
+        @param platform - The platform dictionary of the entry (os, architecture, variant)
+    '''
+    def __is_selected_platform(self, platform):
+        if not self.platforms:
             return True
+        for os_name, architecture, variant in self.platforms:
+            if platform.get('os') == os_name and platform.get('architecture') == architecture \
+                    and (variant is None or platform.get('variant') == variant):
+                return True
+        return False
+
+    '''
+        Gets the child manifests of a manifest list, CHILD_MANIFEST_FETCHES at a time
+        @param digests - The digests of the child manifests
+        @return The list of child Manifests (in the order of the digests), or None
+    '''
+    def __get_child_manifests(self, source, image, digests):
+        results = [None] * len(digests)
+        slots = threading.Semaphore(CHILD_MANIFEST_FETCHES)
+
+        def fetch(i, access):
+            try:
+                results[i] = self.__get_child_manifest(access, image, digests[i])
+            except Exception as ex:
+                self.log.error("Unable to get manifest %s for %s: %s" % (digests[i], image, ex))
+            finally:
+                slots.release()
+
+        threads = []
+        for i in range(len(digests)):
+            slots.acquire()
+            # Each fetch has its own access, the access objects are not thread safe
+            t = Thread(target=fetch, args=(i, source.fork()))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return results if all(results) else None
+
+    '''
+        Gets a child manifest and verifies it matches its digest
+        @return The Manifest, or None
+    '''
+    def __get_child_manifest(self, source, image, digest):
+        manifest = source.get_manifest(image, digest)
+        if not manifest:
+            return None
+        if digest.startswith('sha256:') and manifest.digest != digest:
+            self.log.error("Manifest %s for %s did not match its digest, got %s" % (digest, image, manifest.digest))
+            return None
+        return manifest
+
+    '''
+        Looks up, in a single bulk request, which of the layers not classified yet are stored in the target
+        Missing layers are then transferred without trying checksum deploys first.
+        @param layers - The layers (in the format 'sha256:03....')
+    '''
+    def __classify_layers(self, target, layers):
+        unknown = []
+        for layer in layers:
+            sha2 = layer.replace('sha256:', '')
+            if sha2 not in self.present_layers and sha2 not in self.absent_layers and sha2 not in unknown:
+                unknown.append(sha2)
+        if not unknown:
+            return
+        found = target.find_layers(unknown)
+        if found is None:
+            # Bulk lookups are not possible, every layer goes through the checksum deploys
+            return
+        for sha2 in unknown:
+            if sha2 in found:
+                self.present_layers.add(sha2)
+                sha1, stored_image = found[sha2]
+                if sha1:
+                    self.__record_sha1(sha2, sha1)
+                if stored_image:
+                    self.layer_images.setdefault(sha2, stored_image)
+            else:
+                self.absent_layers.add(sha2)
+
+    '''
+        Makes sure the specified layer is in the target for the specified image/tag
+        A layer already transferred (for another image/tag) is only checksum deployed, and a layer being transferred
+        by another worker is waited for instead of being transferred twice. A layer that failed for other images is
+        attempted again for this one (the failure may be specific to the other images).
+        @return True if the layer is in the target, else False
+    '''
+    def __migrate_layer(self, source, target, image, tag, layer, layer_file):
+        sha2 = layer.replace('sha256:', '')
+        state, sha1 = self.layers.begin(sha2, image)
+        if state == DONE:
+            # The blob is in Artifactory, mount it or deploy it by checksum (the sha1 is known if it was downloaded)
+            if self.__mount_layer(target, image, sha2) or target.checksum_deploy_sha2(image, tag, sha2) \
+                    or (sha1 and target.checksum_deploy_sha1(image, tag, sha2, sha1)):
+                return True
+            return self.__transfer_layer(source, target, image, tag, layer, layer_file)[0]
+        if state != OWNER:
+            self.log.error("Unable to transfer layer %s for %s/%s, it failed too many times for %s"
+                           % (layer, image, tag, image))
+            return False
+        success, sha1 = False, None
+        try:
+            success, sha1 = self.__transfer_layer(source, target, image, tag, layer, layer_file)
+            if success:
+                # Known before the workers waiting for the layer wake up
+                self.layer_images.setdefault(sha2, image)
+        finally:
+            self.layers.finish(sha2, success, sha1)
+        if success:
+            self.absent_layers.discard(sha2)
+            self.present_layers.add(sha2)
+        return success
+
+    '''
+        Transfers the specified layer from the source to the target for the specified image/tag
+        @return (True if the layer was transferred, the sha1 of the layer if it is known)
+    '''
+    def __transfer_layer(self, source, target, image, tag, layer, layer_file):
+        sha2 = layer.replace('sha256:', '')
+        # Checksum deploys can only succeed if the target already stores the layer
+        absent = sha2 in self.absent_layers
+        if not absent and self.__mount_layer(target, image, sha2):
+            return True, None
+        # Try to perform a sha2 checksum deploy to avoid downloading the layer from source
+        if not absent and target.checksum_deploy_sha2(image, tag, sha2):
+            return True, None
+        # If the sha1 is known (from an earlier download), try a sha1 checksum deploy before downloading the layer
+        sha1 = self.digest_index.get_sha1(sha2) if self.digest_index and not absent else None
+        if sha1 and target.checksum_deploy_sha1(image, tag, sha2, sha1):
+            return True, sha1
+        # Use the copy of the layer in the cache (if any) rather than the source
+        cached = self.blob_cache.open(sha2) if self.blob_cache else None
+        if cached:
+            return self.__deploy_cached_layer(target, image, tag, layer, absent, *cached)
+        if self.stream_layers:
+            # Pipe the layer from the source straight into Artifactory
+            sha1 = self.__stream_layer(source, target, image, tag, layer)
+            if not sha1:
+                self.log.error("Unable to stream layer %s for %s/%s" % (layer, image, tag))
+                return False, None
+            if sha1 is True:
+                return True, None
+            self.__record_sha1(sha2, sha1)
+            return True, sha1
+        # Sha2 checksum failed, download the file (continuing an earlier interrupted download if there is one)
+        # The sha1 is only computed if a checksum deploy, the cache or the index can use it
+        need_sha1 = not absent or bool(self.blob_cache or self.digest_index)
+        resume = self.__claim_partial_download(sha2, layer_file)
+        sha1 = source.download_layer(image, layer, layer_file, resume=resume, sha1=need_sha1)
+        if not sha1:
+            self.__keep_partial_download(sha2, layer_file)
+            self.log.error("Unable to get layer %s for %s/%s..." % (layer, image, tag))
+            return False, None
+        if sha1 is True:
+            sha1 = None
         else:
-            self.log.error("Unable to get manifest for %s/%s..." % (image, tag))
+            self.__record_sha1(sha2, sha1)
+        if self.blob_cache and self.blob_cache.add(sha2, sha1, layer_file):
+            cached = self.blob_cache.open(sha2)
+            if not cached:
+                self.log.error("Layer %s for %s/%s was evicted from the cache" % (layer, image, tag))
+                return False, None
+            return self.__deploy_cached_layer(target, image, tag, layer, absent, *cached)
+        # Try a sha1 checksum deploy to avoid upload to target
+        if absent or not target.checksum_deploy_sha1(image, tag, sha2, sha1):
+            # All checksum deploys failed, perform an actual upload
+            if not target.upload_layer(image, tag, sha2, layer_file):
+                self.log.error("Unable to upload layer %s for %s/%s" % (layer, image, tag))
+                return False, None
+        return True, sha1
+
+    '''
+        Mounts the layer from the image of the target it is stored under, if the target uses the V2 push API
+        @return True if the layer was mounted
+    '''
+    def __mount_layer(self, target, image, sha2):
+        from_image = self.layer_images.get(sha2)
+        if not target.push_api or not from_image:
             return False
+        return target.mount_layer(image, sha2, from_image)
 
-    def get_failure_queue(self):
-        return self.failure_queue
+    '''
+        Records the sha1 of a layer in the digest index (if any)
+    '''
+    def __record_sha1(self, sha2, sha1):
+        if self.digest_index:
+            try:
+                self.digest_index.add(sha2, sha1)
+            except Exception as ex:
+                self.log.warning("Unable to record the sha1 of layer %s: %s" % (sha2, ex))
 
-    def get_skipped_queue(self):
-        return self.skipped_queue
+    '''
+        Deploys the specified layer from its copy in the cache
+        @param absent - True if the target is known not to store the layer (no checksum deploy is tried)
+        @param fp - The open cached layer, closed when done
+        @param sha1 - The sha1 of the layer
+        @param size - The size of the layer
+        @return (True if the layer was deployed, the sha1 of the layer)
+    '''
+    def __deploy_cached_layer(self, target, image, tag, layer, absent, fp, sha1, size):
+        sha2 = layer.replace('sha256:', '')
+        try:
+            # Try a sha1 checksum deploy to avoid upload to target
+            if (not absent and target.checksum_deploy_sha1(image, tag, sha2, sha1)) \
+                    or target.upload_layer_from_stream(image, tag, sha2, fp, size):
+                return True, sha1
+        finally:
+            fp.close()
+        self.log.error("Unable to upload layer %s for %s/%s" % (layer, image, tag))
+        return False, None
 
+    '''
+        Streams the specified layer from the source to the target, verifying its sha256 on the fly
+        The uploaded layer is deleted if its content does not match the expected sha256
+        @return The sha1 of the layer if it was uploaded (True if it was not computed), else False
+    '''
+    def __stream_layer(self, source, target, image, tag, layer):
+        sha2 = layer.replace('sha256:', '')
+        response = source.open_layer(image, layer)
+        if not response:
+            return False
+        # The sha1 is only computed for the index (no checksum deploy follows a streamed upload)
+        reader = None
+        try:
+            # If the source does not announce the size, the layer is uploaded with chunked transfer encoding
+            length = response.info().get('Content-Length')
+            if length is not None:
+                length = int(length)
+            reader = HashingReader(response, length, throttle=source.throttle_read, sha1=bool(self.digest_index))
+            if not target.upload_layer_from_stream(image, tag, sha2, reader, length):
+                return False
+        finally:
+            response.close()
+            if reader:
+                reader.close()
+        found_sha = reader.sha256_hexdigest()
+        if found_sha != sha2:
+            self.log.error("Layer did not match expected sha. Expected %s but got %s" % (sha2, found_sha))
+            target.delete_layer(image, tag, sha2)
+            return False
+        return reader.sha1_hexdigest() or True
 
+    '''
+        Moves the partial download of a layer left by an earlier run (if any) to the layer file of this worker
+        The move is atomic, so only one worker can claim a partial download
+        @return True if the layer file now contains the beginning of the layer
+    '''
+    def __claim_partial_download(self, sha2, layer_file):
+        partial_file = os.path.join(self.partial_dir, sha2)
+        try:
+            os.rename(partial_file, layer_file)
+            return True
+        except OSError:
+            return False
 
+    '''
+        Keeps the content of an interrupted layer download so it can be resumed by a later run
+    '''
+    def __keep_partial_download(self, sha2, layer_file):
+        try:
+            if os.path.exists(layer_file) and os.path.getsize(layer_file) > 0:
+                if not os.path.exists(self.partial_dir):
+                    os.makedirs(self.partial_dir)
+                os.rename(layer_file, os.path.join(self.partial_dir, sha2))
+        except OSError as ex:
+            self.log.info("Unable to keep the partial download of layer %s: %s" % (sha2, ex))
 
+    def get_failure_queue(self):
+        return self.failure_queue
 
+    def get_skipped_queue(self):
+        return self.skipped_queue
 
 
+'''
+    Parses platforms given as <os>/<architecture>[/<variant>] (e.g. linux/amd64 or linux/arm64/v8)
+    @param specs - The platforms
+    @return List of (os, architecture, variant) tuples, the variant is None when not specified
+    @raise ValueError - If a platform is invalid
+'''
+def parse_platforms(specs):
+    platforms = []
+    for spec in specs or []:
+        parts = spec.strip().split('/')
+        if len(parts) not in (2, 3) or not all(parts):
+            raise ValueError("Invalid platform '%s', expected <os>/<architecture>[/<variant>]" % spec)
+        platforms.append((parts[0], parts[1], parts[2] if len(parts) == 3 else None))
+    return platforms
@@ -1,4 +1,5 @@
 from HTTPAccess import HTTPAccess
+from DecompressingReader import ACCEPT_ENCODING
 import logging
 '''
     Simple API for accessing various Quay resources
@@ -24,7 +25,8 @@ class QuayAccess:
     def get_catalog(self):
         repos = None
         path = "api/v1/repository?public=true&namespace=%s" % self.namespace
-        resp, stat = self.access.do_unprocessed_request(method='GET', path=path, headers=self.headers)
+        headers = dict(self.headers, **{'Accept-Encoding': ACCEPT_ENCODING})
+        resp, stat = self.access.do_unprocessed_request(method='GET', path=path, headers=headers)
         if stat == 200:
             processed_response = self.access.process_response(resp)
             if 'repositories' in processed_response:
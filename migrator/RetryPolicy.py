@@ -0,0 +1,186 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+# Globals
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30
+# Never wait longer than this, even if the server asks for it with Retry-After
+MAX_RETRY_AFTER = 300
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_COOLDOWN = 30
+MAX_COOLDOWN = 300
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+# Responses that mean the request may succeed if sent again
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Responses that mean the request was not processed, so even non idempotent requests can be sent again
+NOT_PROCESSED_STATUSES = (429, 503)
+# Responses that mean the host is in trouble (as opposed to throttling us)
+HOST_DOWN_STATUSES = (502, 503, 504)
+
+'''
+    Decides if (and when) a failed request should be sent again
+    * GET, HEAD, PUT and DELETE are retried on connection errors and on 429/5xx responses
+    * POST (and other non idempotent methods) are only retried on 429/503, which mean the request was not processed
+    * Requests whose body can't be produced again are never retried
+    * The delay grows exponentially (with full jitter), unless the server provides a Retry-After
+
+    @param max_retries - The maximum number of times a request is sent again
+    @param base_delay - The delay (in seconds) before the first retry
+    @param max_delay - The maximum delay (in seconds) between two retries
+'''
+class RetryPolicy(object):
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    '''
+        Changes the policy settings
+        @param max_retries - The maximum number of times a request is sent again
+    '''
+    def configure(self, max_retries=None):
+        if max_retries is not None:
+            self.max_retries = max_retries
+
+    '''
+        Returns the circuit breaker of the specified host (shared by everyone using this policy)
+        @param host - The host (and port) of the endpoint
+    '''
+    def get_breaker(self, host):
+        with self.lock:
+            breaker = self.breakers.get(host)
+            if not breaker:
+                breaker = CircuitBreaker(host)
+                self.breakers[host] = breaker
+            return breaker
+
+    '''
+        Returns the number of seconds to wait before sending the request again, or None if it should not be
+        @param method - The HTTP method of the request
+        @param status - The status of the response, None if no response was received (connection error)
+        @param attempt - The number of retries already performed
+        @param retry_after - The value of the Retry-After header of the response (if any)
+        @param replayable - False if the body of the request can't be sent again
+    '''
+    def get_delay(self, method, status, attempt, retry_after=None, replayable=True):
+        if attempt >= self.max_retries or not replayable:
+            return None
+        if method in IDEMPOTENT_METHODS:
+            if status is not None and status not in RETRYABLE_STATUSES:
+                return None
+        elif status not in NOT_PROCESSED_STATUSES:
+            return None
+        delay = self.__parse_retry_after(retry_after)
+        if delay is not None:
+            return min(delay, MAX_RETRY_AFTER)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def __parse_retry_after(self, retry_after):
+        if not retry_after:
+            return None
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+        parsed = parsedate_tz(retry_after)
+        if parsed:
+            return max(mktime_tz(parsed) - time.time(), 0)
+        return None
+
+
+'''
+    Per host circuit breaker
+    After failure_threshold consecutive failures (connection errors, 502, 503, 504), the host is considered down:
+    every request to it waits for the cooldown instead of hammering it. Once the cooldown is over, a single request
+    is let through to probe the host. If it succeeds, everyone resumes, otherwise the cooldown starts again (and
+    doubles, up to MAX_COOLDOWN).
+
+    @param host - The host (and port) this breaker protects
+'''
+class CircuitBreaker(object):
+    def __init__(self, host, failure_threshold=DEFAULT_FAILURE_THRESHOLD, cooldown=DEFAULT_COOLDOWN):
+        self.log = logging.getLogger(__name__)
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = None
+        self.probing = False
+        self.condition = threading.Condition()
+
+    '''
+        Blocks while the host is considered down
+    '''
+    def before_request(self):
+        with self.condition:
+            while True:
+                if self.open_until is None:
+                    return
+                now = time.time()
+                if now < self.open_until:
+                    self.condition.wait(self.open_until - now)
+                elif not self.probing:
+                    # Let this request probe the host
+                    self.probing = True
+                    return
+                else:
+                    # Wait for the probe to come back
+                    self.condition.wait(1)
+
+    '''
+        Records a request that reached the host and was served
+    '''
+    def record_success(self):
+        with self.condition:
+            if self.open_until is not None:
+                self.log.warning("Host %s is responding again, resuming requests." % self.host)
+            self.failures = 0
+            self.open_until = None
+            self.probing = False
+            self.cooldown = self.base_cooldown
+            self.condition.notify_all()
+
+    '''
+        Records a request that failed because of the host (connection error, 502, 503, 504)
+    '''
+    def record_failure(self):
+        with self.condition:
+            self.failures += 1
+            if self.probing:
+                self.probing = False
+                self.cooldown = min(self.cooldown * 2, MAX_COOLDOWN)
+                self.__open()
+            elif self.open_until is None and self.failures >= self.failure_threshold:
+                self.__open()
+            self.condition.notify_all()
+
+    '''
+        Records a request that was abandoned before the host could answer (e.g. its body could not be produced)
+    '''
+    def record_abandon(self):
+        with self.condition:
+            if self.probing:
+                self.probing = False
+                self.condition.notify_all()
+
+    def __open(self):
+        self.open_until = time.time() + self.cooldown
+        self.log.warning("Host %s appears to be down after %d consecutive failures, pausing requests to it for %d "
+                         "seconds." % (self.host, self.failures, self.cooldown))
+
+
+_default_policy = RetryPolicy()
+
+'''
+    Returns the process wide retry policy shared by all HTTPAccess instances
+'''
+def get_default_policy():
+    return _default_policy
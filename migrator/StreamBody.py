@@ -0,0 +1,71 @@
+# Globals
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+'''
+    A request body produced on the fly instead of being held in memory
+    * Sent with the provided Content-Length or, when the length is unknown, with 'Transfer-Encoding: chunked'
+    * At most block_size bytes are handed to the socket at once
+
+    @param source - A file like object (anything with read), an iterator/iterable of strings or a string
+    @param length - (optional) The number of bytes the source will produce
+    @param block_size - (optional) The size of the blocks read from a file like source
+    @param throttle - (optional) Callable invoked with the size of every block before it is sent (bandwidth limits)
+    @param replayable - (optional) True if the request can be sent again with the same content (e.g. the caller
+                        rewinds a file), defaults to True for a string source only
+'''
+class StreamBody(object):
+    def __init__(self, source, length=None, block_size=DEFAULT_BLOCK_SIZE, throttle=None, replayable=None):
+        if isinstance(source, basestring) and length is None:
+            length = len(source)
+        self.source = source
+        self.length = length
+        self.block_size = block_size
+        self.throttle = throttle
+        self.replayable = isinstance(source, basestring) if replayable is None else replayable
+        self.sent = 0
+
+    '''
+        True if the content can be produced again, should the request fail
+    '''
+    def is_replayable(self):
+        return self.replayable
+
+    '''
+        True if the body has to be sent with chunked transfer encoding
+    '''
+    def is_chunked(self):
+        return self.length is None
+
+    '''
+        Sends the body on an HTTP connection whose headers have already been sent
+        @param conn - The httplib connection
+    '''
+    def write_to(self, conn):
+        for block in self.__blocks():
+            if self.length is not None and self.sent + len(block) > self.length:
+                raise IOError("Body produced more than the announced %d bytes." % self.length)
+            self.sent += len(block)
+            if self.throttle:
+                self.throttle(len(block))
+            if self.is_chunked():
+                conn.send('%x\r\n' % len(block))
+                conn.send(block)
+                conn.send('\r\n')
+            else:
+                conn.send(block)
+        if self.is_chunked():
+            conn.send('0\r\n\r\n')
+        elif self.sent < self.length:
+            raise IOError("Body ended after %d of the announced %d bytes." % (self.sent, self.length))
+
+    def __blocks(self):
+        if isinstance(self.source, basestring):
+            chunks = [self.source]
+        elif hasattr(self.source, 'read'):
+            chunks = iter(lambda: self.source.read(self.block_size), '')
+        else:
+            chunks = self.source
+        for chunk in chunks:
+            # Never hand more than a block to the socket at once
+            for offset in xrange(0, len(chunk), self.block_size):
+                yield chunk[offset:offset + self.block_size]
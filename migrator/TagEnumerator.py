@@ -0,0 +1,129 @@
+import logging
+import threading
+from Queue import Queue
+
+# Globals
+NUM_OF_ENUMERATORS = 8
+
+'''
+    Lists the tags of the images on a pool of threads and queues the image/tags for the Migrator as they are found
+    Runs alongside the Migrator (the producer of its work queue), so transfers start as soon as the first image is
+    listed instead of after the tags of every image. The tags of an image are queued together, in the order the
+    images are added.
+
+    @param source - The access to the source registry (forked by every thread)
+    @param work_queue - The queue the (image, tag) tuples to migrate are put in
+    @param target_tags - (optional) The TargetTags of the target, tags already in the target are not queued
+    @param workers - The number of threads listing tags
+'''
+class TagEnumerator(object):
+    def __init__(self, source, work_queue, target_tags=None, workers=NUM_OF_ENUMERATORS):
+        self.log = logging.getLogger(__name__)
+        self.source = source
+        self.work_queue = work_queue
+        self.target_tags = target_tags
+        self.workers = workers
+        self.images = Queue()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.finished = threading.Event()
+        self.skipped = []
+        self.counts = {'added': 0, 'repositories': 0, 'tags': 0, 'queued': 0, 'skipped': 0, 'failed': 0}
+
+    '''
+        Starts the threads listing the tags
+    '''
+    def start(self):
+        self.running = self.workers
+        for i in range(self.workers):
+            t = threading.Thread(target=self.__worker, name='Enumerator-%d' % i)
+            t.daemon = True
+            t.start()
+
+    '''
+        Adds an image to enumerate
+        @param image - The image name
+        @param tags - (optional) The tags to migrate, all the tags of the image (listed from the source) if None
+    '''
+    def add(self, image, tags=None):
+        with self.lock:
+            self.counts['added'] += 1
+        self.images.put((image, tags))
+
+    '''
+        Signals that all the images were added, the threads stop once they are enumerated
+    '''
+    def close(self):
+        for i in range(self.workers):
+            self.images.put(None)
+
+    '''
+        Waits for all the added images to be enumerated (after close)
+        @param timeout - (optional) The maximum number of seconds to wait
+        @return True if the enumeration is finished
+    '''
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    '''
+        Returns the number of images added and enumerated (repositories), of tags found, queued, skipped (already in
+        the target) and of images whose tags could not be listed (failed)
+    '''
+    def get_counts(self):
+        with self.lock:
+            return dict(self.counts)
+
+    '''
+        Returns the list of (image, tag) tuples not queued because they already exist in the target
+    '''
+    def get_skipped(self):
+        with self.lock:
+            return list(self.skipped)
+
+    def __worker(self):
+        # The endpoint resources are not thread safe, make (cheap) copies
+        source = self.source.fork()
+        target = self.target_tags.target.fork() if self.target_tags else None
+        try:
+            while True:
+                item = self.images.get()
+                if item is None:
+                    return
+                image, tags = item
+                try:
+                    self.__enumerate(source, target, image, tags)
+                except Exception as ex:
+                    self.log.error("Unable to enumerate the tags of %s: %s" % (image, ex))
+                    with self.lock:
+                        self.counts['repositories'] += 1
+                        self.counts['failed'] += 1
+        finally:
+            with self.lock:
+                self.running -= 1
+                if not self.running:
+                    self.finished.set()
+
+    def __enumerate(self, source, target, image, tags):
+        image = str(image)
+        if tags is None:
+            tags = source.get_tags(image)
+            if tags is False:
+                with self.lock:
+                    self.counts['repositories'] += 1
+                    self.counts['failed'] += 1
+                return
+            tags = [str(tag) for tag in tags or []]
+            self.log.info("Found %d tags for repository %s." % (len(tags), image))
+        # The tags in the target are listed once per image, if they can't be listed all the tags are queued
+        # (the workers then check each of them)
+        existing = self.target_tags.get_tags(image, target) if self.target_tags else None
+        skipped = [(image, tag) for tag in tags if existing is not None and tag in existing]
+        for tag in tags:
+            if existing is None or tag not in existing:
+                self.work_queue.put((image, tag))
+        with self.lock:
+            self.counts['repositories'] += 1
+            self.counts['tags'] += len(tags)
+            self.counts['queued'] += len(tags) - len(skipped)
+            self.counts['skipped'] += len(skipped)
+            self.skipped.extend(skipped)
@@ -0,0 +1,60 @@
+import logging
+import threading
+
+'''
+    Tags already present in the target repository, listed once per image (tags/list) and shared by all the workers
+    Replaces a manifest HEAD per tag to decide which image/tags can be skipped.
+
+    @param target - The ArtifactoryDockerAccess of the target repository
+'''
+class TargetTags(object):
+    def __init__(self, target):
+        self.log = logging.getLogger(__name__)
+        self.target = target
+        self.lock = threading.Lock()
+        self.tags = {}
+        self.image_locks = {}
+
+    '''
+        True if the image/tag is in the target, False if it isn't, None if the tags of the image could not be listed
+        @param image - The image name
+        @param tag - The tag name
+        @param access - (optional) The ArtifactoryDockerAccess to list the tags with (e.g. the fork of a worker)
+    '''
+    def has_tag(self, image, tag, access=None):
+        tags = self.get_tags(image, access)
+        if tags is None:
+            return None
+        return tag in tags
+
+    '''
+        Returns the set of tags of the image in the target (listed on first use), or None if they could not be listed
+        @param image - The image name
+        @param access - (optional) The ArtifactoryDockerAccess to list the tags with (e.g. the fork of a worker)
+    '''
+    def get_tags(self, image, access=None):
+        with self.lock:
+            if image in self.tags:
+                return self.tags[image]
+            image_lock = self.image_locks.setdefault(image, threading.Lock())
+        # Only one worker lists the tags of an image, the others wait for the result
+        with image_lock:
+            with self.lock:
+                if image in self.tags:
+                    return self.tags[image]
+            tags = (access or self.target).get_tags(image)
+            tags = set(tags) if tags is not None else None
+            with self.lock:
+                self.tags[image] = tags
+            return tags
+
+    '''
+        Records a tag deployed to the target
+        @param image - The image name
+        @param tag - The tag name
+    '''
+    def add(self, image, tag):
+        with self.lock:
+            tags = self.tags.get(image)
+            if tags is not None:
+                tags.add(tag)
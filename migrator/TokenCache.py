@@ -0,0 +1,196 @@
+import base64
+import calendar
+import hashlib
+import json
+import re
+import threading
+import time
+
+# Globals
+# Lifetime of a token whose response does not provide expires_in (as per the Docker token spec)
+DEFAULT_EXPIRES_IN = 60
+# Tokens are refreshed when less than this many seconds (or a quarter of their lifetime) are left
+DEFAULT_REFRESH_MARGIN = 15
+# Maximum number of scopes requested in a single token request (keeps the token URL short)
+MAX_SCOPES_PER_TOKEN = 10
+
+'''
+    Process wide cache of registry bearer tokens, shared by all the workers
+    * Tokens are keyed by realm, service, scope and credentials (see get_key)
+    * A token is refreshed shortly before it expires, by a single thread while the others keep using it
+    * The token server (realm and service) of each registry is remembered once a challenge has been seen,
+      so the tokens can be requested before sending a request instead of after a 401
+
+    @param refresh_margin - The number of seconds before expiry a token is refreshed
+'''
+class TokenCache(object):
+    def __init__(self, refresh_margin=DEFAULT_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.key_locks = {}
+        self.challenges = {}
+
+    '''
+        Returns the (realm, service) of the token server of the registry, or None if not known yet
+        @param registry - The URL of the registry
+    '''
+    def get_challenge(self, registry):
+        with self.lock:
+            return self.challenges.get(registry)
+
+    '''
+        Remembers the token server of the registry
+        @param registry - The URL of the registry
+        @param realm - The URL of the token server
+        @param service - The service the tokens are requested for (may be None)
+    '''
+    def set_challenge(self, registry, realm, service):
+        with self.lock:
+            self.challenges[registry] = (realm, service)
+
+    '''
+        Returns a valid token for the key, fetching a new one if there is none or it is about to expire
+        @param key - The key of the token (see get_key)
+        @param fetch - Callable fetching a new token, returns (token, expires_in, issued_at) or None
+        @param rejected - A token the registry refused, it is never returned
+        @return The token, or None if none could be fetched
+    '''
+    def get_token(self, key, fetch, rejected=None):
+        token = self.__lookup(key, rejected, True)
+        if token:
+            return token
+        key_lock = self.__get_key_lock(key)
+        if not key_lock.acquire(False):
+            # Another thread is fetching this token, keep using the current one while it is still valid
+            token = self.__lookup(key, rejected, False)
+            if token:
+                return token
+            key_lock.acquire()
+        try:
+            # The token may have been fetched while waiting for the lock
+            token = self.__lookup(key, rejected, True)
+            if token:
+                return token
+            result = fetch()
+            if not result:
+                return None
+            self.put([key], *result)
+            return result[0]
+        finally:
+            key_lock.release()
+
+    '''
+        Stores a token valid for several keys (a token requested for several scopes at once)
+        @param keys - The keys the token is valid for
+        @param token - The token
+        @param expires_in - The lifetime of the token (in seconds) provided by the token server, if any
+        @param issued_at - The RFC3339 issue time provided by the token server, if any
+    '''
+    def put(self, keys, token, expires_in=None, issued_at=None):
+        now = time.time()
+        lifetime = expires_in if expires_in and expires_in > 0 else DEFAULT_EXPIRES_IN
+        issued = parse_issued_at(issued_at)
+        # Ignore an issue time in the future (clock skew), the token can't be older than now
+        if issued is None or issued > now:
+            issued = now
+        with self.lock:
+            for key in keys:
+                self.tokens[key] = (token, issued + lifetime, lifetime)
+
+    '''
+        Returns the keys, among the specified ones, without a token that is far enough from expiry
+        @param keys - The keys to check
+    '''
+    def get_missing(self, keys):
+        return [key for key in keys if not self.__lookup(key, None, True)]
+
+    def __lookup(self, key, rejected, fresh):
+        with self.lock:
+            entry = self.tokens.get(key)
+        if not entry:
+            return None
+        token, expires_at, lifetime = entry
+        if token == rejected:
+            return None
+        limit = expires_at - min(self.refresh_margin, lifetime / 4.0) if fresh else expires_at
+        if time.time() < limit:
+            return token
+        return None
+
+    def __get_key_lock(self, key):
+        with self.lock:
+            key_lock = self.key_locks.get(key)
+            if not key_lock:
+                key_lock = threading.Lock()
+                self.key_locks[key] = key_lock
+            return key_lock
+
+
+'''
+    Returns the cache key of a token
+    The credentials are part of the key (hashed), so different users never share a token
+    @param realm - The URL of the token server
+    @param service - The service the token is for
+    @param scope - The scope of the token (may be None)
+    @param username - The username used to get the token (may be None)
+    @param password - The password used to get the token (may be None)
+'''
+def get_key(realm, service, scope, username=None, password=None):
+    credentials = None
+    if username or password:
+        credentials = hashlib.sha256('%s:%s' % (username, password)).hexdigest()
+    return realm, service, scope, credentials
+
+
+'''
+    Parses the RFC3339 issued_at of a token response
+    @return The issue time (seconds since the epoch), or None if it is missing or invalid
+'''
+def parse_issued_at(issued_at):
+    if not issued_at:
+        return None
+    match = re.match(r'^(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)(?:\.\d+)?(?:([Zz])|([+-])(\d\d):(\d\d))$',
+                     issued_at.strip())
+    if not match:
+        return None
+    year, month, day, hour, minute, second = [int(g) for g in match.groups()[:6]]
+    timestamp = calendar.timegm((year, month, day, hour, minute, second, 0, 0, 0))
+    if match.group(8):
+        offset = int(match.group(9)) * 3600 + int(match.group(10)) * 60
+        timestamp -= offset if match.group(8) == '+' else -offset
+    return timestamp
+
+
+'''
+    Returns the scopes granted by a token, from the access claim of its JWT payload (as per the Docker token spec)
+    A scope the token server refused is left out of the claim instead of failing the whole request.
+    @param token - The token
+    @return The set of granted scopes (e.g. 'repository:library/ubuntu:pull'), or None if the token is not a JWT
+'''
+def get_granted_scopes(token):
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None
+    try:
+        payload = parts[1].encode('ascii')
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        granted = set()
+        for access in claims.get('access') or []:
+            actions = access.get('actions') or []
+            if '*' in actions:
+                actions = list(actions) + ['pull', 'push']
+            for action in actions:
+                granted.add('%s:%s:%s' % (access['type'], access['name'], action))
+        return granted
+    except (ValueError, TypeError, KeyError, AttributeError, UnicodeError):
+        return None
+
+
+_default_cache = TokenCache()
+
+'''
+    Returns the process wide token cache shared by all DockerTokenAccess instances
+'''
+def get_default_token_cache():
+    return _default_cache
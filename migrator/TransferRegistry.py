@@ -0,0 +1,74 @@
+import threading
+
+# Globals
+OWNER = 'owner'
+IN_FLIGHT = 'in flight'
+DONE = 'done'
+FAILED = 'failed'
+MAX_ATTEMPTS = 3
+
+'''
+    Keeps track of transfers identified by a key (e.g. a layer digest), shared by all the workers
+    * The first worker asking for a key becomes its owner and performs the transfer
+    * Workers asking for a key in flight wait for the owner to finish instead of transferring it again
+    * Once done, the key is reported as done along with what the owner recorded about it (e.g. its sha1)
+    * A failed transfer is attempted again by the next worker asking for it, up to max_attempts times per origin
+      (e.g. the image a layer is transferred for), so a failure specific to one origin doesn't fail the others
+
+    @param max_attempts - The number of times a transfer is attempted (per origin) before it is reported as failed
+'''
+class TransferRegistry(object):
+    def __init__(self, max_attempts=MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.transfers = {}
+
+    '''
+        Claims the transfer of the key, or waits until its owner finishes it
+        @param key - The key of the transfer
+        @param origin - (optional) What the transfer is performed for, the attempts are counted per origin
+        @return (OWNER, info) if the caller has to perform the transfer (and call finish),
+                (DONE, info) if it was performed, or (FAILED, info) if it failed too many times for that origin
+    '''
+    def begin(self, key, origin=None):
+        while True:
+            with self.lock:
+                transfer = self.transfers.get(key)
+                if not transfer:
+                    transfer = {'state': FAILED, 'info': None, 'attempts': {}, 'finished': None}
+                    self.transfers[key] = transfer
+                attempts = transfer['attempts'].get(origin, 0)
+                if transfer['state'] == FAILED and attempts < self.max_attempts:
+                    transfer['state'] = IN_FLIGHT
+                    transfer['attempts'][origin] = attempts + 1
+                    transfer['finished'] = threading.Event()
+                    return OWNER, transfer['info']
+                if transfer['state'] != IN_FLIGHT:
+                    return transfer['state'], transfer['info']
+                finished = transfer['finished']
+            finished.wait()
+
+    '''
+        Records the outcome of a transfer claimed with begin and wakes up the workers waiting for it
+        @param key - The key of the transfer
+        @param success - True if the transfer succeeded
+        @param info - (optional) Information about the transfer handed to the next callers of begin
+    '''
+    def finish(self, key, success, info=None):
+        with self.lock:
+            transfer = self.transfers[key]
+            transfer['state'] = DONE if success else FAILED
+            if info is not None:
+                transfer['info'] = info
+            finished = transfer['finished']
+        finished.set()
+
+    '''
+        Returns the number of transfers per state
+    '''
+    def get_counts(self):
+        counts = {IN_FLIGHT: 0, DONE: 0, FAILED: 0}
+        with self.lock:
+            for transfer in self.transfers.values():
+                counts[transfer['state']] += 1
+        return counts
@@ -0,0 +1,137 @@
+import unittest
+import shutil
+import tempfile
+import time
+import os, sys
+# Allows easily running the tests without setting up python path
+sys.path.append((os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from migrator.BandwidthGovernor import BandwidthGovernor, TokenBucket, parse_limits, READ, WRITE
+
+
+'''
+    Test the parsing of the bandwidth limits
+'''
+class ParseLimitsTest(unittest.TestCase):
+
+    def test_global_limits(self):
+        self.assertEqual(parse_limits(['read=100', 'write=2K']), {(READ, None): 100, (WRITE, None): 2048})
+
+    def test_endpoint_limits(self):
+        self.assertEqual(parse_limits(['read@Registry.example.com:5000=20M', 'WRITE@artifactory = 1.5G']),
+                         {(READ, 'registry.example.com:5000'): 20 * 1024 ** 2,
+                          (WRITE, 'artifactory'): int(1.5 * 1024 ** 3)})
+
+    def test_units(self):
+        self.assertEqual(parse_limits(['read=10k'])[(READ, None)], 10240)
+        self.assertEqual(parse_limits(['read=10MB'])[(READ, None)], 10 * 1024 ** 2)
+        self.assertEqual(parse_limits(['read=0.5K'])[(READ, None)], 512)
+
+    def test_unlimited(self):
+        self.assertEqual(parse_limits(['read=0']), {(READ, None): 0})
+
+    def test_last_wins(self):
+        self.assertEqual(parse_limits(['read=1K', 'read=2K']), {(READ, None): 2048})
+
+    def test_no_limits(self):
+        self.assertEqual(parse_limits(None), {})
+        self.assertEqual(parse_limits([]), {})
+
+    def test_invalid_limits(self):
+        for spec in ('read', 'read=', 'upload=1M', 'read=1T', 'read=-1', 'read@=1M', 'read@host=fast',
+                     'read write=1M', '=1M'):
+            self.assertRaises(ValueError, parse_limits, [spec])
+
+
+'''
+    Test the bandwidth governor:
+      * Token bucket delays
+      * Changing the limits, 0 lifting them
+      * Reloading the limits from the control file
+'''
+class BandwidthGovernorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.governor = BandwidthGovernor()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bandwidth.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000)
+        # The bucket starts empty and holds at most a second worth of bytes
+        self.assertAlmostEqual(bucket.consume(500), 0.5, places=1)
+        self.assertAlmostEqual(bucket.consume(1000), 1.5, places=1)
+
+    def test_unlimited_bucket(self):
+        bucket = TokenBucket(0)
+        self.assertEqual(bucket.consume(10 ** 9), 0)
+
+    def test_set_limits(self):
+        self.governor.set_limits({(READ, None): 1000, (WRITE, 'artifactory'): 2000})
+        self.assertEqual(self.get_rates(), {(READ, None): 1000, (WRITE, 'artifactory'): 2000})
+        self.governor.set_limits({(READ, None): 500})
+        # The limits not specified anymore are lifted
+        self.assertEqual(self.get_rates(), {(READ, None): 500, (WRITE, 'artifactory'): 0})
+
+    def test_zero_lifts_limit(self):
+        self.governor.set_limits({(READ, None): 10})
+        self.governor.set_limits({(READ, None): 0})
+        start = time.time()
+        self.governor.throttle(READ, 'registry', 10 ** 6)
+        self.assertTrue(time.time() - start < 0.1)
+
+    def test_throttle(self):
+        self.governor.set_limits({(READ, 'registry'): 10000})
+        start = time.time()
+        self.governor.throttle(READ, 'registry', 2000)
+        self.assertTrue(time.time() - start >= 0.15)
+        # Other endpoints and directions are not limited
+        start = time.time()
+        self.governor.throttle(READ, 'other', 10 ** 6)
+        self.governor.throttle(WRITE, 'registry', 10 ** 6)
+        self.assertTrue(time.time() - start < 0.1)
+
+    def test_control_file_reload(self):
+        self.governor.watch_control_file(self.path, {(READ, None): 1000}, interval=0.05)
+        # No control file yet, the base limits apply
+        self.assertEqual(self.get_rates(), {(READ, None): 1000})
+        self.write_control_file('# Limits\n\nread=0\nwrite@artifactory=1K\n', 1)
+        self.assertTrue(self.wait_for_rates({(READ, None): 0, (WRITE, 'artifactory'): 1024}))
+        self.write_control_file('write=2K\n', 2)
+        self.assertTrue(self.wait_for_rates({(READ, None): 1000, (WRITE, 'artifactory'): 0, (WRITE, None): 2048}))
+        # An invalid file is ignored as a whole, the base limits apply
+        self.write_control_file('write=2K\nwrite=fast\n', 3)
+        self.assertTrue(self.wait_for_rates({(READ, None): 1000, (WRITE, 'artifactory'): 0, (WRITE, None): 0}))
+        os.remove(self.path)
+        self.write_control_file('read=5K\n', 4)
+        self.assertTrue(self.wait_for_rates({(READ, None): 5120, (WRITE, 'artifactory'): 0, (WRITE, None): 0}))
+
+    def test_existing_control_file(self):
+        self.write_control_file('read=2K\n', 1)
+        self.governor.watch_control_file(self.path, {(READ, None): 1000, (WRITE, None): 1000}, interval=0.05)
+        self.assertEqual(self.get_rates(), {(READ, None): 2048, (WRITE, None): 1000})
+
+    def get_rates(self):
+        return dict((key, bucket.rate) for key, bucket in self.governor.buckets.items())
+
+    def wait_for_rates(self, rates, timeout=2):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.get_rates() == rates:
+                return True
+            time.sleep(0.02)
+        return False
+
+    def write_control_file(self, contents, version):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+        # The file is reloaded when its modification time changes, don't depend on the file system resolution
+        mtime = time.time() + version * 10
+        os.utime(self.path, (mtime, mtime))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import unittest
+import hashlib
+import json
+import os, sys
+# Allows easily running the tests without setting up python path
+sys.path.append((os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from migrator.Manifest import Manifest, MANIFEST_V2, MANIFEST_LIST_V2, OCI_MANIFEST, OCI_INDEX, OCI_CONFIG, \
+    FOREIGN_LAYER_TYPES
+from migrator.Migrator import parse_platforms
+
+CONFIG = 'sha256:' + 'c' * 64
+LAYER1 = 'sha256:' + '1' * 64
+LAYER2 = 'sha256:' + '2' * 64
+FOREIGN = 'sha256:' + 'f' * 64
+AMD64 = 'sha256:' + 'a' * 64
+ARM64 = 'sha256:' + 'b' * 64
+ARMV7 = 'sha256:' + 'd' * 64
+
+SCHEMA1 = '''{
+   "schemaVersion": 1,
+   "name": "library/busybox",
+   "tag": "latest",
+   "architecture": "amd64",
+   "fsLayers": [
+      {"blobSum": "%s"},
+      {"blobSum": "%s"},
+      {"blobSum": "%s"},
+      {"blobSum": "%s"}
+   ],
+   "history": []
+}''' % (LAYER1, LAYER2, LAYER1, LAYER1)
+
+SCHEMA2 = '''{
+   "schemaVersion": 2,
+   "mediaType": "%s",
+   "config": {"mediaType": "application/vnd.docker.container.image.v1+json", "size": 10, "digest": "%s"},
+   "layers": [
+      {"mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip", "size": 20, "digest": "%s"},
+      {"mediaType": "%s", "size": 30, "digest": "%s", "urls": ["https://example.com/layer"]},
+      {"mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip", "size": 40, "digest": "%s"},
+      {"mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip", "size": 20, "digest": "%s"}
+   ]
+}''' % (MANIFEST_V2, CONFIG, LAYER1, FOREIGN_LAYER_TYPES[0], FOREIGN, LAYER2, LAYER1)
+
+OCI = '''{
+   "schemaVersion": 2,
+   "config": {"mediaType": "%s", "size": 10, "digest": "%s"},
+   "layers": [
+      {"mediaType": "application/vnd.oci.image.layer.v1.tar+gzip", "size": 20, "digest": "%s"},
+      {"mediaType": "application/vnd.oci.image.layer.nondistributable.v1.tar+gzip", "size": 30, "digest": "%s"}
+   ]
+}''' % (OCI_CONFIG, CONFIG, LAYER1, FOREIGN)
+
+LIST = '''{
+   "schemaVersion": 2,
+   "mediaType": "%s",
+   "manifests": [
+      {"mediaType": "%s", "size": 100, "digest": "%s", "platform": {"architecture": "amd64", "os": "linux"}},
+      {"mediaType": "%s", "size": 100, "digest": "%s",
+       "platform": {"architecture": "arm64", "os": "linux", "variant": "v8"}},
+      {"mediaType": "%s", "size": 100, "digest": "%s",
+       "platform": {"architecture": "arm", "os": "linux", "variant": "v7"}}
+   ]
+}''' % (MANIFEST_LIST_V2, MANIFEST_V2, AMD64, MANIFEST_V2, ARM64, MANIFEST_V2, ARMV7)
+
+# An OCI index without mediaType (optional in the OCI spec), with an entry without platform
+INDEX = '''{
+   "schemaVersion": 2,
+   "manifests": [
+      {"mediaType": "%s", "size": 100, "digest": "%s", "platform": {"architecture": "amd64", "os": "linux"}},
+      {"mediaType": "%s", "size": 100, "digest": "%s"}
+   ]
+}''' % (OCI_MANIFEST, AMD64, OCI_MANIFEST, ARM64)
+
+
+'''
+    Test the parsing of the manifests:
+      * Type of schema1, schema2, OCI manifests and of manifest lists / OCI indexes
+      * Layer plan: config first, each blob once, no foreign layers
+      * Children of the lists, and selecting some of them
+'''
+class ManifestTest(unittest.TestCase):
+
+    def test_digest(self):
+        manifest = Manifest(SCHEMA2)
+        self.assertEqual(manifest.digest, 'sha256:' + hashlib.sha256(SCHEMA2).hexdigest())
+        self.assertEqual(manifest.contents, SCHEMA2)
+
+    def test_schema1(self):
+        manifest = Manifest(SCHEMA1)
+        self.assertEqual(manifest.type, 'application/json')
+        self.assertFalse(manifest.is_list())
+        self.assertEqual(manifest.get_layers(), [LAYER1, LAYER2])
+        self.assertEqual(manifest.get_children(), [])
+
+    def test_schema2(self):
+        manifest = Manifest(SCHEMA2)
+        self.assertEqual(manifest.type, MANIFEST_V2)
+        self.assertFalse(manifest.is_list())
+        self.assertEqual(manifest.get_layers(), [CONFIG, LAYER1, LAYER2])
+        self.assertEqual(manifest.get_children(), [])
+
+    def test_schema2_without_media_type(self):
+        js = json.loads(SCHEMA2)
+        del js['mediaType']
+        self.assertEqual(Manifest(json.dumps(js)).type, MANIFEST_V2)
+
+    def test_oci_manifest(self):
+        manifest = Manifest(OCI)
+        self.assertEqual(manifest.type, OCI_MANIFEST)
+        self.assertFalse(manifest.is_list())
+        self.assertEqual(manifest.get_layers(), [CONFIG, LAYER1])
+
+    def test_manifest_list(self):
+        manifest = Manifest(LIST)
+        self.assertEqual(manifest.type, MANIFEST_LIST_V2)
+        self.assertTrue(manifest.is_list())
+        self.assertEqual(manifest.get_layers(), [])
+        self.assertEqual(manifest.get_children(), [
+            (AMD64, MANIFEST_V2, {'architecture': 'amd64', 'os': 'linux'}),
+            (ARM64, MANIFEST_V2, {'architecture': 'arm64', 'os': 'linux', 'variant': 'v8'}),
+            (ARMV7, MANIFEST_V2, {'architecture': 'arm', 'os': 'linux', 'variant': 'v7'})])
+
+    def test_oci_index(self):
+        manifest = Manifest(INDEX)
+        self.assertEqual(manifest.type, OCI_INDEX)
+        self.assertTrue(manifest.is_list())
+        self.assertEqual(manifest.get_layers(), [])
+        self.assertEqual(manifest.get_children(), [(AMD64, OCI_MANIFEST, {'architecture': 'amd64', 'os': 'linux'}),
+                                                   (ARM64, OCI_MANIFEST, {})])
+
+    def test_select_children(self):
+        manifest = Manifest(LIST)
+        selected = manifest.select_children([AMD64, ARMV7])
+        self.assertEqual([child[0] for child in selected.get_children()], [AMD64, ARMV7])
+        self.assertEqual(selected.type, MANIFEST_LIST_V2)
+        # A new manifest, with its own digest, the original is left untouched
+        self.assertNotEqual(selected.digest, manifest.digest)
+        self.assertEqual(json.loads(selected.contents)['mediaType'], MANIFEST_LIST_V2)
+        self.assertEqual(len(manifest.get_children()), 3)
+
+    def test_select_all_children(self):
+        manifest = Manifest(LIST)
+        selected = manifest.select_children([AMD64, ARM64, ARMV7])
+        self.assertEqual(selected.get_children(), manifest.get_children())
+
+    def test_invalid_manifests(self):
+        for contents in ('not json', '{"schemaVersion": 2}', '{"schemaVersion": 2, "config": []}',
+                         '{"schemaVersion": 1}', '{"schemaVersion": 2, "mediaType": "%s"}' % MANIFEST_LIST_V2,
+                         '{"schemaVersion": 2, "config": {"digest": "%s"}, "layers": [{}]}' % CONFIG):
+            self.assertRaises(ValueError, Manifest, contents)
+
+
+'''
+    Test the parsing of the --platform arguments
+'''
+class ParsePlatformsTest(unittest.TestCase):
+
+    def test_platforms(self):
+        self.assertEqual(parse_platforms(['linux/amd64', ' linux/arm64/v8 ', 'windows/amd64']),
+                         [('linux', 'amd64', None), ('linux', 'arm64', 'v8'), ('windows', 'amd64', None)])
+
+    def test_no_platforms(self):
+        self.assertEqual(parse_platforms(None), [])
+        self.assertEqual(parse_platforms([]), [])
+
+    def test_invalid_platforms(self):
+        for spec in ('linux', 'linux/', '/amd64', 'linux//v8', 'linux/arm64/v8/extra', ''):
+            self.assertRaises(ValueError, parse_platforms, [spec])
+
+
+if __name__ == '__main__':
+    unittest.main()
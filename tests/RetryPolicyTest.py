@@ -0,0 +1,150 @@
+import unittest
+import threading
+import time
+from email.utils import formatdate
+import os, sys
+# Allows easily running the tests without setting up python path
+sys.path.append((os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from migrator.RetryPolicy import RetryPolicy, CircuitBreaker, MAX_RETRY_AFTER
+
+
+'''
+    Test the retry decisions:
+      * Exponential backoff and its cap
+      * Retry-After (seconds and HTTP date)
+      * Which methods and statuses are retried
+'''
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(max_retries=10, base_delay=0.5, max_delay=4)
+
+    def test_backoff_growth(self):
+        for attempt in range(4):
+            bound = 0.5 * (2 ** attempt)
+            delays = [self.policy.get_delay('GET', 503, attempt) for i in range(200)]
+            self.assertTrue(all(0 <= delay <= bound for delay in delays))
+            # Full jitter, but the delays should use the whole window
+            self.assertTrue(max(delays) > bound / 2)
+
+    def test_backoff_cap(self):
+        delays = [self.policy.get_delay('GET', 503, 8) for i in range(200)]
+        self.assertTrue(all(0 <= delay <= 4 for delay in delays))
+        self.assertTrue(max(delays) > 2)
+
+    def test_max_retries(self):
+        self.assertIsNotNone(self.policy.get_delay('GET', 503, 9))
+        self.assertIsNone(self.policy.get_delay('GET', 503, 10))
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(self.policy.get_delay('GET', 429, 0, retry_after='7'), 7)
+        self.assertEqual(self.policy.get_delay('GET', 429, 0, retry_after='-3'), 0)
+        self.assertEqual(self.policy.get_delay('GET', 429, 0, retry_after='100000'), MAX_RETRY_AFTER)
+
+    def test_retry_after_date(self):
+        retry_after = formatdate(time.time() + 60, usegmt=True)
+        delay = self.policy.get_delay('GET', 503, 0, retry_after=retry_after)
+        self.assertTrue(58 <= delay <= 60)
+        retry_after = formatdate(time.time() - 60, usegmt=True)
+        self.assertEqual(self.policy.get_delay('GET', 503, 0, retry_after=retry_after), 0)
+
+    def test_invalid_retry_after(self):
+        delay = self.policy.get_delay('GET', 503, 0, retry_after='soon')
+        self.assertTrue(0 <= delay <= 0.5)
+
+    def test_idempotent_methods(self):
+        for method in ('GET', 'HEAD', 'PUT', 'DELETE'):
+            for status in (None, 429, 500, 502, 503, 504):
+                self.assertIsNotNone(self.policy.get_delay(method, status, 0))
+            for status in (400, 401, 404, 501):
+                self.assertIsNone(self.policy.get_delay(method, status, 0))
+
+    def test_post_only_when_not_processed(self):
+        self.assertIsNotNone(self.policy.get_delay('POST', 429, 0))
+        self.assertIsNotNone(self.policy.get_delay('POST', 503, 0))
+        for status in (None, 500, 502, 504, 400):
+            self.assertIsNone(self.policy.get_delay('POST', status, 0))
+
+    def test_not_replayable(self):
+        self.assertIsNone(self.policy.get_delay('PUT', 503, 0, replayable=False))
+        self.assertIsNone(self.policy.get_delay('PUT', None, 0, replayable=False))
+        self.assertIsNone(self.policy.get_delay('POST', 429, 0, retry_after='1', replayable=False))
+
+    def test_shared_breakers(self):
+        breaker = self.policy.get_breaker('registry:5000')
+        self.assertIs(self.policy.get_breaker('registry:5000'), breaker)
+        self.assertIsNot(self.policy.get_breaker('other:5000'), breaker)
+
+
+'''
+    Test the circuit breaker:
+      * It opens after the threshold of consecutive failures
+      * A single probe is let through after the cooldown, and closes it when it succeeds
+'''
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('registry:5000', failure_threshold=5, cooldown=0.2)
+
+    def test_success_resets_failures(self):
+        for i in range(4):
+            self.breaker.record_failure()
+        self.breaker.record_success()
+        for i in range(4):
+            self.breaker.record_failure()
+        self.assertIsNone(self.breaker.open_until)
+
+    def test_opens_after_threshold(self):
+        for i in range(4):
+            self.breaker.record_failure()
+        self.assertIsNone(self.breaker.open_until)
+        self.breaker.record_failure()
+        self.assertIsNotNone(self.breaker.open_until)
+        start = time.time()
+        self.breaker.before_request()
+        # The request waited for the cooldown and is the probe
+        self.assertTrue(time.time() - start >= 0.15)
+        self.assertTrue(self.breaker.probing)
+
+    def test_probe_success_closes(self):
+        for i in range(5):
+            self.breaker.record_failure()
+        self.breaker.before_request()
+        released = []
+        waiter = threading.Thread(target=lambda: (self.breaker.before_request(), released.append(time.time())))
+        waiter.daemon = True
+        waiter.start()
+        # Only the probe goes through while it is in flight
+        time.sleep(0.1)
+        self.assertEqual(released, [])
+        self.breaker.record_success()
+        waiter.join(2)
+        self.assertEqual(len(released), 1)
+        self.assertIsNone(self.breaker.open_until)
+        self.assertFalse(self.breaker.probing)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_probe_failure_reopens(self):
+        for i in range(5):
+            self.breaker.record_failure()
+        self.breaker.before_request()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.probing)
+        self.assertAlmostEqual(self.breaker.cooldown, 0.4)
+        self.assertTrue(self.breaker.open_until > time.time())
+
+    def test_probe_abandon(self):
+        for i in range(5):
+            self.breaker.record_failure()
+        self.breaker.before_request()
+        self.breaker.record_abandon()
+        # Someone else can probe right away
+        start = time.time()
+        self.breaker.before_request()
+        self.assertTrue(time.time() - start < 0.1)
+        self.assertTrue(self.breaker.probing)
+
+
+if __name__ == '__main__':
+    unittest.main()
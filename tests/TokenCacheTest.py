@@ -0,0 +1,177 @@
+import unittest
+import base64
+import calendar
+import json
+import time
+import os, sys
+# Allows easily running the tests without setting up python path
+sys.path.append((os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from migrator.TokenCache import TokenCache, get_key, parse_issued_at, get_granted_scopes, DEFAULT_EXPIRES_IN
+from migrator.DockerTokenAccess import DockerTokenAccess
+
+REALM = 'https://auth.example.com/token'
+SERVICE = 'registry.example.com'
+
+
+'''
+    Builds an (unsigned) JWT with the specified access claim
+'''
+def make_jwt(access):
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+    return '%s.%s.%s' % (encode({'alg': 'none'}), encode({'iss': 'auth', 'access': access}), 'signature')
+
+
+'''
+    Test the parsing of the token responses:
+      * issued_at (RFC3339)
+      * The scopes granted by a JWT
+'''
+class TokenParsingTest(unittest.TestCase):
+
+    def test_parse_issued_at(self):
+        expected = calendar.timegm((2024, 3, 1, 12, 30, 15, 0, 0, 0))
+        self.assertEqual(parse_issued_at('2024-03-01T12:30:15Z'), expected)
+        self.assertEqual(parse_issued_at('2024-03-01t12:30:15z'), expected)
+        self.assertEqual(parse_issued_at('2024-03-01 12:30:15Z'), expected)
+
+    def test_parse_issued_at_fractional_seconds(self):
+        expected = calendar.timegm((2024, 3, 1, 12, 30, 15, 0, 0, 0))
+        self.assertEqual(parse_issued_at('2024-03-01T12:30:15.123456789Z'), expected)
+        self.assertEqual(parse_issued_at('2024-03-01T14:30:15.5+02:00'), expected)
+
+    def test_parse_issued_at_offset(self):
+        expected = calendar.timegm((2024, 3, 1, 12, 30, 15, 0, 0, 0))
+        self.assertEqual(parse_issued_at('2024-03-01T14:30:15+02:00'), expected)
+        self.assertEqual(parse_issued_at('2024-03-01T07:00:15-05:30'), expected)
+        self.assertEqual(parse_issued_at('2024-03-01T12:30:15+00:00'), expected)
+
+    def test_parse_invalid_issued_at(self):
+        for issued_at in (None, '', 'yesterday', '2024-03-01', '2024-03-01T12:30:15', '2024-03-01T12:30:15+0200'):
+            self.assertIsNone(parse_issued_at(issued_at))
+
+    def test_granted_scopes(self):
+        token = make_jwt([{'type': 'repository', 'name': 'library/ubuntu', 'actions': ['pull']},
+                          {'type': 'repository', 'name': 'team/app', 'actions': ['pull', 'push']},
+                          {'type': 'repository', 'name': 'team/denied', 'actions': []}])
+        self.assertEqual(get_granted_scopes(token), set(['repository:library/ubuntu:pull',
+                                                         'repository:team/app:pull',
+                                                         'repository:team/app:push']))
+
+    def test_granted_wildcard(self):
+        token = make_jwt([{'type': 'registry', 'name': 'catalog', 'actions': ['*']}])
+        self.assertEqual(get_granted_scopes(token), set(['registry:catalog:*', 'registry:catalog:pull',
+                                                         'registry:catalog:push']))
+
+    def test_granted_nothing(self):
+        self.assertEqual(get_granted_scopes(make_jwt(None)), set())
+        self.assertEqual(get_granted_scopes(make_jwt([])), set())
+
+    def test_not_a_jwt(self):
+        self.assertIsNone(get_granted_scopes('opaque-token'))
+        self.assertIsNone(get_granted_scopes('a.!!!.c'))
+        self.assertIsNone(get_granted_scopes('a.%s.c' % base64.urlsafe_b64encode('not json')))
+        self.assertIsNone(get_granted_scopes(make_jwt([{'name': 'no type', 'actions': ['pull']}])))
+
+
+'''
+    Test the token cache:
+      * Expiry, with the refresh margin
+      * Prefetched tokens are only cached for the scopes they grant
+'''
+class TokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TokenCache(refresh_margin=15)
+        self.key = get_key(REALM, SERVICE, 'repository:library/ubuntu:pull', 'user', 'secret')
+
+    def test_keys(self):
+        self.assertEqual(self.key, get_key(REALM, SERVICE, 'repository:library/ubuntu:pull', 'user', 'secret'))
+        self.assertNotEqual(self.key, get_key(REALM, SERVICE, 'repository:library/ubuntu:pull', 'user', 'other'))
+        self.assertNotEqual(self.key, get_key(REALM, SERVICE, 'repository:library/ubuntu:pull'))
+        self.assertFalse('secret' in repr(self.key))
+
+    def test_valid_token(self):
+        self.cache.put([self.key], 'token', 300)
+        self.assertEqual(self.cache.get_token(self.key, self.fail), 'token')
+        self.assertEqual(self.cache.get_missing([self.key]), [])
+
+    def test_refresh_margin(self):
+        # Expires in 10 seconds, within the 15 seconds margin
+        self.cache.put([self.key], 'old', 300, self.__issued_at(290))
+        self.assertEqual(self.cache.get_missing([self.key]), [self.key])
+        self.assertEqual(self.cache.get_token(self.key, lambda: ('new', 300, None)), 'new')
+        # Expires in 20 seconds, outside the margin
+        self.cache.put([self.key], 'old', 300, self.__issued_at(280))
+        self.assertEqual(self.cache.get_token(self.key, self.fail), 'old')
+
+    def test_short_lived_margin(self):
+        # The margin is at most a quarter of the lifetime: 10 seconds left out of 40 is still fresh enough
+        self.cache.put([self.key], 'token', 40, self.__issued_at(29))
+        self.assertEqual(self.cache.get_token(self.key, self.fail), 'token')
+        self.cache.put([self.key], 'token', 40, self.__issued_at(31))
+        self.assertEqual(self.cache.get_missing([self.key]), [self.key])
+
+    def test_expired_token(self):
+        self.cache.put([self.key], 'old', 60, self.__issued_at(61))
+        self.assertEqual(self.cache.get_token(self.key, lambda: ('new', 60, None)), 'new')
+        self.assertEqual(self.cache.get_token(self.key, lambda: None), 'new')
+
+    def test_default_lifetime(self):
+        self.cache.put([self.key], 'token', None, self.__issued_at(DEFAULT_EXPIRES_IN - 20))
+        self.assertEqual(self.cache.get_token(self.key, self.fail), 'token')
+        self.cache.put([self.key], 'token', 0, self.__issued_at(DEFAULT_EXPIRES_IN))
+        self.assertEqual(self.cache.get_missing([self.key]), [self.key])
+
+    def test_future_issued_at(self):
+        # Clock skew, the token is considered issued now
+        self.cache.put([self.key], 'token', 60, self.__issued_at(-3600))
+        self.assertEqual(self.cache.get_token(self.key, self.fail), 'token')
+
+    def test_rejected_token(self):
+        self.cache.put([self.key], 'bad', 300)
+        self.assertEqual(self.cache.get_token(self.key, lambda: ('good', 300, None), rejected='bad'), 'good')
+
+    def test_failed_fetch(self):
+        self.assertIsNone(self.cache.get_token(self.key, lambda: None))
+        self.assertEqual(self.cache.get_missing([self.key]), [self.key])
+
+    def test_prefetch_granted_scopes(self):
+        access = DockerTokenAccess(url='https://' + SERVICE, username='user', password='secret',
+                                   token_cache=self.cache)
+        self.cache.set_challenge(access.url, REALM, SERVICE)
+        requests = []
+        token = make_jwt([{'type': 'repository', 'name': 'library/ubuntu', 'actions': ['pull']},
+                          {'type': 'repository', 'name': 'library/denied', 'actions': []}])
+
+        def fetch_token(realm, service, scopes):
+            requests.append(scopes)
+            return token, 300, None
+        access._DockerTokenAccess__fetch_token = fetch_token
+        access.prefetch_tokens(['library/ubuntu', 'library/denied', 'library/ubuntu'])
+        self.assertEqual(requests, [['repository:library/ubuntu:pull', 'repository:library/denied:pull']])
+        denied = get_key(REALM, SERVICE, 'repository:library/denied:pull', 'user', 'secret')
+        self.assertEqual(self.cache.get_missing([self.key, denied]), [denied])
+        # Only the missing scopes are requested again
+        access.prefetch_tokens(['library/ubuntu', 'library/denied'])
+        self.assertEqual(requests[1:], [['repository:library/denied:pull']])
+
+    def test_prefetch_opaque_token(self):
+        access = DockerTokenAccess(url='https://' + SERVICE, username='user', password='secret',
+                                   token_cache=self.cache)
+        self.cache.set_challenge(access.url, REALM, SERVICE)
+        access._DockerTokenAccess__fetch_token = lambda realm, service, scopes: ('opaque', 300, None)
+        access.prefetch_tokens(['library/ubuntu', 'library/debian'])
+        debian = get_key(REALM, SERVICE, 'repository:library/debian:pull', 'user', 'secret')
+        self.assertEqual(self.cache.get_missing([self.key, debian]), [])
+
+    def fail(self):
+        raise AssertionError("The token should not be fetched")
+
+    def __issued_at(self, age):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - age))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+import threading
+import time
+import os, sys
+# Allows easily running the tests without setting up python path
+sys.path.append((os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from migrator.TransferRegistry import TransferRegistry, OWNER, DONE, FAILED, IN_FLIGHT
+
+LAYER = 'sha256:' + '1' * 64
+
+
+'''
+    Test the transfers shared by the workers:
+      * A key in flight is transferred once, the other workers wait for it
+      * A failed transfer is attempted again, up to the limit, per origin
+'''
+class TransferRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = TransferRegistry(max_attempts=3)
+
+    def test_in_flight_coalescing(self):
+        self.assertEqual(self.registry.begin(LAYER, 'library/ubuntu'), (OWNER, None))
+        results = []
+        waiters = [threading.Thread(target=lambda: results.append(self.registry.begin(LAYER, 'library/debian')))
+                   for i in range(4)]
+        for waiter in waiters:
+            waiter.daemon = True
+            waiter.start()
+        # The second begin waits for the owner
+        time.sleep(0.2)
+        self.assertEqual(results, [])
+        self.assertEqual(self.registry.get_counts()[IN_FLIGHT], 1)
+        self.registry.finish(LAYER, True, 'sha1')
+        for waiter in waiters:
+            waiter.join(2)
+        self.assertEqual(results, [(DONE, 'sha1')] * 4)
+        self.assertEqual(self.registry.begin(LAYER), (DONE, 'sha1'))
+
+    def test_waiter_takes_over_failure(self):
+        self.assertEqual(self.registry.begin(LAYER, 'library/ubuntu'), (OWNER, None))
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(self.registry.begin(LAYER, 'library/ubuntu')))
+        waiter.daemon = True
+        waiter.start()
+        time.sleep(0.2)
+        self.assertEqual(results, [])
+        self.registry.finish(LAYER, False)
+        waiter.join(2)
+        # The failed transfer is attempted again by the waiting worker
+        self.assertEqual(results, [(OWNER, None)])
+        self.registry.finish(LAYER, True)
+        self.assertEqual(self.registry.begin(LAYER, 'library/ubuntu'), (DONE, None))
+
+    def test_single_owner(self):
+        results = []
+        lock = threading.Lock()
+
+        def worker():
+            state, info = self.registry.begin(LAYER)
+            with lock:
+                results.append(state)
+            if state == OWNER:
+                time.sleep(0.1)
+                self.registry.finish(LAYER, True)
+        workers = [threading.Thread(target=worker) for i in range(10)]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            t.join(2)
+        self.assertEqual(sorted(results), [DONE] * 9 + [OWNER])
+
+    def test_attempt_limit(self):
+        for i in range(3):
+            self.assertEqual(self.registry.begin(LAYER, 'library/ubuntu'), (OWNER, None))
+            self.registry.finish(LAYER, False)
+        self.assertEqual(self.registry.begin(LAYER, 'library/ubuntu'), (FAILED, None))
+        self.assertEqual(self.registry.begin(LAYER, 'library/ubuntu'), (FAILED, None))
+
+    def test_attempt_limit_per_origin(self):
+        for i in range(3):
+            self.assertEqual(self.registry.begin(LAYER, 'library/ubuntu')[0], OWNER)
+            self.registry.finish(LAYER, False)
+        self.assertEqual(self.registry.begin(LAYER, 'library/ubuntu')[0], FAILED)
+        # Another image sharing the layer still gets its own attempts
+        self.assertEqual(self.registry.begin(LAYER, 'library/debian')[0], OWNER)
+        self.registry.finish(LAYER, True, 'sha1')
+        self.assertEqual(self.registry.begin(LAYER, 'library/ubuntu'), (DONE, 'sha1'))
+
+    def test_info_kept(self):
+        self.assertEqual(self.registry.begin(LAYER)[0], OWNER)
+        self.registry.finish(LAYER, False, 'partial')
+        # The next owner gets what the previous one recorded
+        self.assertEqual(self.registry.begin(LAYER), (OWNER, 'partial'))
+        self.registry.finish(LAYER, True)
+        self.assertEqual(self.registry.begin(LAYER), (DONE, 'partial'))
+
+    def test_counts(self):
+        self.registry.begin(LAYER)
+        self.registry.begin('sha256:' + '2' * 64)
+        self.registry.finish('sha256:' + '2' * 64, True)
+        self.registry.begin('sha256:' + '3' * 64)
+        self.registry.finish('sha256:' + '3' * 64, False)
+        self.assertEqual(self.registry.get_counts(), {IN_FLIGHT: 1, DONE: 1, FAILED: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()